@@ -1,62 +1,347 @@
-from flask import Flask, request, jsonify,render_template
-import cv2
+from flask import Flask, Response, request, jsonify,render_template
+from flask_sock import Sock
+import json
+import logging
+import queue
+import atexit
+import select
+import signal
+import socket
 import asyncio
-from aiohttp import ClientSession, FormData
-import numpy as np  # 添加这行代码来导入 numpy 库
-from fortuneteller import *
+import threading
+import concurrent.futures
+from aiohttp import ClientSession, ClientTimeout, FormData, TCPConnector
+from config import Config
+from fortuneteller import configure_gpt, analyze_in_batches, chat_completion_async, chat_completion_stream
+from fortune_cache import FortuneCache
+from face_filter import LocalFaceFilter, restore_rectangle
+from frame_gate import FrameGates
+from scheduler import Scheduler, RateLimited, INTERACTIVE
+from coalesce import SessionJobs
+from emotion_state import EmotionStates
+from warm_pool import WarmPool
+from track_cache import TrackCache
+from circuit import CircuitBreaker, CircuitOpen, RemoteError
+from fallback import canned_fortune
+from frame_codec import jpeg_size, decode_frame, encode_frame, reduce_factor, CodecStats
+from image_executor import ImageExecutor, detect_faces, crop_and_encode, fit_and_encode
+import metrics
+from metrics import timed, events_total
 
 
 app = Flask(__name__)
 
-# ... (其余函数保持不变，包括read_credentials, detect_faces_async, analyze_faces_async, retry_on_error)
-# Semaphore to limit concurrent requests
-# semaphore = asyncio.Semaphore(1)
+# Settings, credentials and endpoints, loaded once at startup (reloaded on SIGHUP)
+config = Config()
+
+# Point the shared GPT client at the configured Azure deployment; returns the
+# replaced client, if any
+def configure_clients():
+    return configure_gpt(config)
+
+configure_clients()
+
+# Debug logging (DEBUG_LOG=1); when off, log.debug() calls skip formatting entirely
+logging.basicConfig(format="[%(levelname)s] %(message)s")
+log = logging.getLogger("fortune")
+log.setLevel(logging.DEBUG if config.debug_log else logging.INFO)
+
+# Fortune cache (sizes are fixed at startup)
+fortune_cache = FortuneCache(
+    max_entries=config.fortune_cache_size,
+    ttl=config.fortune_cache_ttl,
+    bucket_size=config.fortune_bucket_size,
+    pool_size=config.fortune_pool_size,
+    path=config.fortune_cache_path
+)
+
+# Local face detection needs OpenCV's Haar cascades; without them the filter
+# and the Face++-down fallback are off
+local_detection = LocalFaceFilter.available()
+if not local_detection:
+    log.warning("This OpenCV build has no Haar cascades; local face detection is disabled")
+
+# Optional local face detection before calling Face++ (LOCAL_FACE_FILTER=0 to disable)
+face_filter = LocalFaceFilter(
+    max_side=config.local_filter_max_side
+) if config.local_face_filter and local_detection else None
+
+# Pool for image decode/filter/encode, so CPU work doesn't pile up on request
+# threads (mode and size are fixed at startup; process workers fork here,
+# before the event loop thread below starts). Its face detector also serves
+# the fallback path while Face++ is down, so it exists even without the filter
+# (its cascade is only loaded once that path runs).
+image_executor = ImageExecutor(
+    mode=config.image_executor,
+    workers=config.image_workers,
+    face_filter=face_filter or LocalFaceFilter(max_side=config.local_filter_max_side)
+)
+
+# Per-client scene-change gate: unchanged frames reuse the last result
+frame_gates = FrameGates(
+    max_sessions=config.max_client_sessions,
+    threshold=config.frame_gate_threshold,
+    max_staleness=config.frame_gate_max_staleness
+)
+
+# Smoothed emotions per viewer (browser session and face); a new fortune is
+# requested only when the dominant emotion changes or the cooldown expires
+emotion_states = EmotionStates(
+    max_viewers=config.max_client_sessions,
+    alpha=config.emotion_smoothing,
+    cooldown=config.emotion_cooldown,
+    context_turns=config.emotion_context_turns
+)
+
+# Face++ results per client, reused while the local detector keeps seeing the
+# same faces in the same places (needs the local face filter)
+track_cache = TrackCache(
+    max_clients=config.max_client_sessions,
+    ttl=config.track_ttl,
+    min_iou=config.track_min_iou
+)
+
+# Newest in-flight job per browser session; a newer frame supersedes older ones
+session_jobs = SessionJobs(max_sessions=config.max_client_sessions)
+
+# Process-wide Face++ rate limiter, shared by every request
+facepp_scheduler = Scheduler(qps=config.facepp_qps, burst=config.facepp_burst)
+
+# Per-dependency circuit breakers: while one is open, calls fail fast and
+# requests take the local fallback path (results are marked degraded)
+facepp_breaker = CircuitBreaker("facepp", config.facepp_breaker_failures, config.facepp_breaker_reset)
+gpt_breaker = CircuitBreaker("gpt", config.gpt_breaker_failures, config.gpt_breaker_reset)
+
+# Upload counters; size and quality are negotiated with the browser (see /frame_config).
+# Compliant JPEGs are forwarded to Face++ as-is; larger ones are re-encoded.
+codec_stats = CodecStats()
+
+# Long-lived event loop in a background thread. Every request runs its
+# coroutines here, so the aiohttp session (and its keep-alive connections)
+# is shared across frames instead of being rebuilt per POST.
+loop = asyncio.new_event_loop()
+threading.Thread(target=loop.run_forever, name="facepp-loop", daemon=True).start()
+
+session = None
+
+# Pre-generated fortunes per emotion and intensity, refilled in the background
+# on the shared loop (WARM_POOL_SIZE=0 to disable)
+warm_pool = WarmPool(
+    generate=lambda emotion, band: generate_warm_fortune(emotion, band),  # Defined further down
+    size=config.warm_pool_size,
+    budget=config.warm_pool_budget,
+    path=config.warm_pool_path
+) if config.warm_pool_size > 0 else None
+
+# The refill task, once started
+warm_pool_refill = None
+warm_pool_lock = threading.Lock()
+
+# Start refilling the warm pool. This happens on the first request, not at
+# import, so processes that only import the app (batch.py, benchmark.py, the
+# debug reloader's parent) don't spend the GPT budget or write the pool file.
+def start_warm_pool():
+    global warm_pool_refill
+    with warm_pool_lock:
+        if warm_pool is not None and warm_pool_refill is None:
+            warm_pool_refill = asyncio.run_coroutine_threadsafe(warm_pool.run(), loop)
+
+@app.before_request
+def before_request():
+    start_warm_pool()
+
+# Get (or lazily create) the pooled session; must run on the background loop
+async def get_session():
+    global session
+    if session is None or session.closed:
+        connector = TCPConnector(
+            limit=config.pool_limit,
+            limit_per_host=config.pool_limit_per_host,
+            ttl_dns_cache=config.dns_cache_ttl,
+            keepalive_timeout=config.keepalive_timeout,
+        )
+        session = ClientSession(connector=connector)
+    return session
+
+# How long a replaced session or GPT client stays open for requests already using it (seconds)
+SESSION_CLOSE_GRACE = 60
+
+# Replace the pooled session so new pool settings take effect, and retire the
+# replaced GPT client; must run on the background loop. New calls get fresh
+# clients at once; closing the old ones would abort their in-flight calls (and
+# trip the breakers), so they are closed only after a grace period.
+async def reset_session(old_gpt_client=None):
+    global session
+    old_session, session = session, None
+    if old_session is None and old_gpt_client is None:
+        return
+    await asyncio.sleep(SESSION_CLOSE_GRACE)
+    if old_session is not None and not old_session.closed:
+        await old_session.close()
+    if old_gpt_client is not None:
+        await old_gpt_client.close()
+
+# Reload settings and credentials on SIGHUP; cache, filter and gate sizes need a restart
+def reload_config(signum=None, frame=None):
+    global config
+    config = Config()
+    old_gpt_client = configure_clients()
+    facepp_scheduler.qps, facepp_scheduler.burst = config.facepp_qps, config.facepp_burst or max(1.0, config.facepp_qps)
+    asyncio.run_coroutine_threadsafe(reset_session(old_gpt_client), loop)
+    log.setLevel(logging.DEBUG if config.debug_log else logging.INFO)
+    log.info("Configuration reloaded")
+
+if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+    signal.signal(signal.SIGHUP, reload_config)
+
+# How often a waiting request checks whether its client went away (seconds)
+DISCONNECT_POLL = 0.5
+
+class ClientDisconnected(Exception):
+    pass
+
+# Check if the browser closed the connection (werkzeug server only)
+def client_disconnected():
+    sock = request.environ.get("werkzeug.socket")
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b""
+    except (OSError, ValueError):
+        return True
+
+# Run a coroutine on the background loop and wait for its result.
+# If cancel_check() turns true while waiting, the coroutine is cancelled.
+def run_async(coro, cancel_check=None):
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    while True:
+        try:
+            return future.result(timeout=DISCONNECT_POLL)
+        except concurrent.futures.TimeoutError:
+            if cancel_check is not None and cancel_check():
+                future.cancel()
+                raise ClientDisconnected()
+
+# The browser session a request belongs to (form field, or query string for WebSockets).
+# None when the client sends no client_id: such requests share no state with
+# others (no superseding, frame gate or per-viewer smoothing), since clients
+# behind one proxy or NAT address can't be told apart.
+def client_key():
+    return request.values.get('client_id') or None
+
+# Start a job for this session on the background loop, superseding (cancelling)
+# the session's previous job if it is still running
+def submit_job(client_id, coro):
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    if client_id is not None:
+        session_jobs.submit(client_id, future)
+    return future
+
+# Wait for a session job. If a newer frame from the same session superseded it,
+# share the newer job's result instead of running the old frame to completion.
+def wait_for_job(client_id, future):
+    own = True
+    while True:
+        try:
+            result = future.result(timeout=DISCONNECT_POLL)
+            return result if own else dict(result, superseded=True)
+        except concurrent.futures.CancelledError:
+            newer = session_jobs.latest(client_id) if client_id is not None else None
+            if newer is None or newer is future:
+                return {'error': 'Superseded by a newer frame', 'superseded': True}
+            future, own = newer, False
+        except concurrent.futures.TimeoutError:
+            if client_disconnected():
+                # Only cancel work this request owns; a newer request may still want it
+                if own:
+                    future.cancel()
+                raise ClientDisconnected()
+
+# Close the shared session when the process exits
+@atexit.register
+def close_session():
+    if session is not None and not session.closed:
+        run_async(session.close())
+    fortune_cache.close()
+    if warm_pool_refill is not None:
+        warm_pool.close()
+    image_executor.close()
+    loop.call_soon_threadsafe(loop.stop)
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
-# Function to read API credentials
-def read_credentials(api_key_file, api_secret_file):
-    with open(api_key_file, 'r') as file:
-        api_key = file.read().strip()
-    with open(api_secret_file, 'r') as file:
-        api_secret = file.read().strip()
-    return api_key, api_secret
+# Upload size/quality the browser should use for frames
+@app.route('/frame_config')
+def frame_config():
+    return jsonify({
+        "max_width": config.frame_max_width,
+        "max_height": config.frame_max_height,
+        "jpeg_quality": config.frame_jpeg_quality / 100
+    })
+
+# Face++ could not be reached: circuit open, timeout, network or server error,
+# or still throttled after retries. Callers fall back to local detection.
+class FaceppUnavailable(Exception):
+    pass
 
 # Function to detect faces
-async def detect_faces_async(frame, api_key, api_secret, session,semaphore):
+async def detect_faces_async(frame, api_key, api_secret, session, semaphore, priority=INTERACTIVE):
     async with semaphore:  # Use semaphore to limit concurrency
-        url = "https://api-us.faceplusplus.com/facepp/v3/detect"
-        _, img_encoded = cv2.imencode('.jpg', frame)
+        url = f"{config.facepp_url}/detect"
+        # Accept ready-made JPEG bytes, or a frame to encode off the event loop
+        if isinstance(frame, bytes):
+            img_bytes = frame
+        else:
+            with timed("encode"):
+                img_bytes = await image_executor.run_async("encode", encode_frame, frame, config.frame_jpeg_quality)
 
         # Prepare the request
-        form = FormData()
-        form.add_field("image_file", img_encoded.tobytes(), filename="frame.jpg", content_type="image/jpeg")
-        form.add_field("api_key", api_key)
-        form.add_field("api_secret", api_secret)
+        def make_form():
+            form = FormData()
+            form.add_field("image_file", img_bytes, filename="frame.jpg", content_type="image/jpeg")
+            form.add_field("api_key", api_key)
+            form.add_field("api_secret", api_secret)
+            return form
 
         try:
-            async with session.post(url, data=form, ssl=False) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    print(f"[DEBUG] Detect Faces Response: {result}")
-
-                    if 'faces' in result and result['faces']:
-                        face_tokens = [face['face_token'] for face in result['faces']]
-                        print(f"[DEBUG] Retrieved Face Tokens: {face_tokens}")
-                        return face_tokens
-                else:
-                    error_text = await response.text()
-                    print(f"[DEBUG] Detect Faces Error: {response.status} - {error_text}")
+            with timed("detect"), facepp_breaker.guard():
+                status, result = await facepp_scheduler.post(
+                    session, url, make_form, priority, config.facepp_max_retries,
+                    ssl=False, timeout=ClientTimeout(total=config.facepp_timeout)
+                )
+                if status >= 500:
+                    raise RemoteError(f"{status} - {result}")
+        except CircuitOpen as e:
+            events_total.inc("circuit_open")
+            raise FaceppUnavailable(str(e)) from e
+        except RateLimited as e:
+            events_total.inc("throttled")
+            log.warning("Detect Faces Throttled: %s", e)
+            raise FaceppUnavailable(str(e)) from e
         except Exception as e:
-            print(f"[DEBUG] Detect Faces Exception: {e}")
+            events_total.inc("detect_error")
+            log.warning("Detect Faces Exception: %s", e)
+            raise FaceppUnavailable(str(e)) from e
+
+        if status == 200:
+            log.debug("Detect Faces Response: %s", result)
+
+            if 'faces' in result and result['faces']:
+                face_tokens = [face['face_token'] for face in result['faces']]
+                log.debug("Retrieved Face Tokens: %s", face_tokens)
+                return face_tokens
+        else:
+            events_total.inc("detect_error")
+            log.warning("Detect Faces Error: %s - %s", status, result)
     return None
 
 # Function to analyze faces
-async def analyze_faces_async(face_tokens, api_key, api_secret, session,semaphore):
+async def analyze_faces_async(face_tokens, api_key, api_secret, session, semaphore, priority=INTERACTIVE):
     async with semaphore:  # Use semaphore to limit concurrency
-        url = "https://api-us.faceplusplus.com/facepp/v3/face/analyze"
+        url = f"{config.facepp_url}/face/analyze"
 
         # Prepare the request with only valid attributes
         data = {
@@ -66,19 +351,33 @@ async def analyze_faces_async(face_tokens, api_key, api_secret, session,semaphor
             "return_attributes": "emotion"  # Valid attributes
         }
 
-        print(f"[DEBUG] Sending Face Tokens for Analysis: {face_tokens}")
+        log.debug("Sending Face Tokens for Analysis: %s", face_tokens)
 
         try:
-            async with session.post(url, data=data, ssl=False) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    print(f"[DEBUG] Analyze Faces Response: {result}")
-                    return result
-                else:
-                    error_text = await response.text()
-                    print(f"[DEBUG] Analyze Faces Error: {response.status} - {error_text}")
+            with timed("analyze"), facepp_breaker.guard():
+                status, result = await facepp_scheduler.post(
+                    session, url, lambda: data, priority, config.facepp_max_retries,
+                    ssl=False, timeout=ClientTimeout(total=config.facepp_timeout)
+                )
+                if status >= 500:
+                    raise RemoteError(f"{status} - {result}")
+        except CircuitOpen as e:
+            events_total.inc("circuit_open")
+            raise FaceppUnavailable(str(e)) from e
+        except RateLimited as e:
+            events_total.inc("throttled")
+            log.warning("Analyze Faces Throttled: %s", e)
+            raise FaceppUnavailable(str(e)) from e
         except Exception as e:
-            print(f"[DEBUG] Analyze Faces Exception: {e}")
+            events_total.inc("analyze_error")
+            log.warning("Analyze Faces Exception: %s", e)
+            raise FaceppUnavailable(str(e)) from e
+
+        if status == 200:
+            log.debug("Analyze Faces Response: %s", result)
+            return result
+        events_total.inc("analyze_error")
+        log.warning("Analyze Faces Error: %s - %s", status, result)
     return None
 
 
@@ -88,87 +387,479 @@ async def retry_on_error(coro_func, retries=3, delay=2):
         try:
             return await coro_func()  # Properly call the coroutine
         except Exception as e:
-            print(f"[DEBUG] Retry ({attempt + 1}/{retries}) after error: {e}")
+            log.warning("Retry (%s/%s) after error: %s", attempt + 1, retries, e)
             await asyncio.sleep(delay * (2 ** attempt))  # Exponential backoff
-    print("[DEBUG] All retries failed.")
+    log.warning("All retries failed.")
     return None
 
+# Prometheus-style metrics: per-stage latency histograms and event counters
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Fortune cache hit/miss and local filter counters
+@app.route('/stats')
+def stats():
+    return jsonify({
+        "fortune_cache": fortune_cache.stats(),
+        "face_filter": face_filter.stats() if face_filter is not None else None,
+        "frame_gate": frame_gates.stats(),
+        "upload": codec_stats.stats(),
+        "image_executor": image_executor.stats(),
+        "facepp_scheduler": facepp_scheduler.stats(),
+        "breakers": {"facepp": facepp_breaker.stats(), "gpt": gpt_breaker.stats()},
+        "sessions": session_jobs.stats(),
+        "emotion_state": emotion_states.stats(),
+        "warm_pool": warm_pool.stats() if warm_pool is not None else None,
+        "track_cache": track_cache.stats()
+    })
+
+# Check an uploaded frame against the client's frame gate and the local face filter and
+# produce the JPEG bytes for Face++. Returns (jpeg, transform, boxes, gate, early_result);
+# boxes are the local detector's full-frame face boxes (None when the filter is off),
+# gate is None without a client_id, early_result is set when no remote analysis is
+# needed, jpeg is None for bad input.
+def prepare_frame(data, client_id):
+    cpu_start = image_executor.thread_time()
+    size = jpeg_size(data)
+    compliant = size is not None and size[0] <= config.frame_max_width and size[1] <= config.frame_max_height
+
+    if compliant:
+        # Zero-copy path: only a small grayscale copy is decoded, for the gate and filter
+        min_width = face_filter.detect_width if face_filter is not None else 32
+        reduce = reduce_factor(size[0], min_width)
+        with timed("decode"):
+            np_frame = image_executor.run("decode", decode_frame, data, True, reduce)
+    else:
+        # Convert image file stream to numpy array
+        with timed("decode"):
+            np_frame = image_executor.run("decode", decode_frame, data)
+    if np_frame is None:
+        return None, None, None, None, None
+
+    # Reuse the last result while this client's scene hasn't changed
+    gate = frame_gates.get(client_id) if client_id is not None else None
+    if gate is not None:
+        with timed("gate"):
+            changed, last_result = gate.check(np_frame)
+        if not changed:
+            events_total.inc("reused")
+            return None, None, None, gate, dict(last_result, reused=True)
+
+    # Skip the Face++ round-trip when no face is visible; otherwise upload only the face region
+    transform, boxes = None, None
+    if compliant:
+        if face_filter is not None:
+            with timed("filter"):
+                boxes = face_filter.count(image_executor.run("filter", detect_faces, np_frame, reduce))
+        jpeg = data if boxes is None or boxes else None
+    elif face_filter is not None:
+        with timed("filter"):
+            boxes = face_filter.count(image_executor.run("filter", detect_faces, np_frame))
+        jpeg = None
+        if boxes:
+            with timed("encode"):
+                jpeg, transform = image_executor.run(
+                    "encode", crop_and_encode, np_frame, boxes, config.frame_jpeg_quality
+                )
+    else:
+        with timed("encode"):
+            jpeg, transform = image_executor.run(
+                "encode", fit_and_encode, np_frame,
+                config.frame_max_width, config.frame_max_height, config.frame_jpeg_quality
+            )
+
+    codec_stats.record(len(data), len(jpeg) if jpeg else 0, image_executor.thread_time() - cpu_start, compliant)
+    if jpeg is None:
+        events_total.inc("filtered")
+        result = {'error': 'No faces detected', 'filtered': True}
+        if gate is not None:
+            gate.store(result)
+        return None, None, None, gate, result
+    events_total.inc("analyzed")
+    return jpeg, transform, boxes, gate, None
+
+# Whether a result is a real observation, not a transient API failure or a degraded
+# answer; only those are reused by the frame gate or checkpointed by batch jobs
+def is_final_result(result):
+    if result.get('degraded'):
+        return False
+    return 'chat_response' in result or result.get('error', '').startswith('No faces')
+
+def store_result(gate, result):
+    if gate is not None and is_final_result(result):
+        gate.store(result)
+
+FORTUNE_SYSTEM_PROMPT = (
+    "You are a cool fortune teller. Based on detected emotions from a person's facial expressions, "
+    "offer a personalized fortune-telling biscuit. Examples:\n"
+)
+
+# Generate a fortune for the warm pool: no particular viewer, just an emotion and intensity
+async def generate_warm_fortune(emotion, band):
+    emotion_text = (
+        f"The dominant emotion detected is '{emotion}', with {band} intensity. "
+        "Please provide a personalized fortune-telling biscuit based on this information."
+    )
+    with timed("gpt_refill"), gpt_breaker.guard():
+        return await chat_completion_async([
+            {"role": "system", "content": FORTUNE_SYSTEM_PROMPT},
+            {"role": "user", "content": emotion_text}
+        ])
+
+# Get a fortune for one analyzed face, from the cache, the warm pool or GPT.
+# With emit, GPT text is streamed as 'token' events while it arrives.
+# With a viewer key, emotions are smoothed across that viewer's frames and
+# the previous fortune is kept until the smoothed dominant emotion changes.
+async def face_fortune(face, index=0, emit=None, viewer=None):
+    emotions = face['attributes'].get('emotion', {})
+    dominant_emotion = max(emotions, key=emotions.get) if emotions else "N/A"
+    fortune = {"face_token": face.get('face_token'), "dominant_emotion": dominant_emotion}
+
+    state = emotion_states.get(viewer) if viewer is not None and emotions else None
+    if state is not None:
+        emotions, dominant_emotion, due = state.update(emotions)
+        fortune.update(dominant_emotion=dominant_emotion, smoothed_emotions=emotions)
+        emotion_states.count(due)
+        if not due:
+            events_total.inc("fortune_held")
+            fortune.update(chat_response=state.fortune, held=True)
+            return fortune
+
+    # Serve a cached fortune for a similar emotion state
+    chat_response = fortune_cache.get(emotions)
+    if chat_response is not None:
+        events_total.inc("cache_hit")
+        if state is not None:
+            state.refreshed(dominant_emotion, chat_response)
+        fortune.update(chat_response=chat_response, cached=True)
+        return fortune
+    events_total.inc("cache_miss")
+
+    # Serve a pre-generated fortune for this emotion and intensity
+    chat_response = warm_pool.take(emotions) if warm_pool is not None and emotions else None
+    if chat_response is not None:
+        events_total.inc("warm_pool_hit")
+        if state is not None:
+            state.refreshed(dominant_emotion, chat_response)
+        fortune.update(chat_response=chat_response, pooled=True)
+        return fortune
+
+    # Add a message to ChatGPT
+    emotion_text = (
+        f"The dominant emotion detected is '{dominant_emotion}'. "
+        f"The detailed emotions are: {emotions}. "
+        "Please provide a personalized fortune-telling biscuit based on this information."
+    )
+    messages = [
+    {"role": "system", "content": FORTUNE_SYSTEM_PROMPT},
+    *(state.context.messages() if state is not None else []),
+    {"role": "user", "content": emotion_text}
+    ]
+
+    try:
+        with timed("gpt"), gpt_breaker.guard():
+            if emit is None:
+                chat_response = await chat_completion_async(messages)
+            else:
+                pieces = []
+                async for piece in chat_completion_stream(messages):
+                    pieces.append(piece)
+                    emit('token', {"face": index, "text": piece})
+                chat_response = "".join(pieces)
+        log.debug("GPT Response Content: %s", chat_response)
+        fortune_cache.put(emotions, chat_response)
+        if state is not None:
+            state.refreshed(dominant_emotion, chat_response)
+            state.context.add(emotion_text, chat_response)
+        fortune["chat_response"] = chat_response
+    except Exception as e:
+        if isinstance(e, CircuitOpen):
+            events_total.inc("circuit_open")
+        else:
+            events_total.inc("gpt_error")
+            log.warning("GPT API Exception: %s", e)
+        # Degrade to any cached fortune for these emotions, else a canned one
+        chat_response = fortune_cache.peek(emotions) or canned_fortune(dominant_emotion)
+        fortune.update(chat_response=chat_response, degraded=True)
+    return fortune
+
+# Face++ is unavailable: find faces with OpenCV and give each one the viewer's
+# previous fortune or a canned one, so the kiosk keeps answering
+async def analyze_frame_locally(jpeg, transform, emit=None, client_id=None):
+    events_total.inc("degraded")
+    if not local_detection:
+        return {'error': 'Face analysis unavailable', 'degraded': True}
+    frame = await image_executor.run_async("decode", decode_frame, jpeg)
+    boxes = await image_executor.run_async("filter", detect_faces, frame) if frame is not None else []
+    if not boxes:
+        return {'error': 'No faces detected', 'degraded': True}
+
+    faces, fortunes = [], []
+    for x, y, w, h in boxes:
+        rectangle = {"left": x, "top": y, "width": w, "height": h}
+        if transform is not None:
+            rectangle = restore_rectangle(rectangle, transform)
+        faces.append({"face_rectangle": rectangle, "attributes": {}})
+    viewers = track_cache.identify(client_id, faces) if client_id is not None else [None] * len(faces)
+    for viewer in viewers:
+        state = emotion_states.get((client_id, viewer)) if viewer is not None else None
+        if state is not None and state.fortune is not None:
+            fortunes.append({"face_token": None, "dominant_emotion": state.dominant,
+                             "chat_response": state.fortune, "held": True, "degraded": True})
+        else:
+            fortunes.append({"face_token": None, "dominant_emotion": "N/A",
+                             "chat_response": canned_fortune(), "degraded": True})
+    analysis = {"faces": faces}
+    if emit is not None:
+        emit('analysis', {"emotion_analysis": analysis})
+    return {
+        "emotion_analysis": analysis,
+        "chat_response": fortunes[0]["chat_response"],
+        "fortunes": fortunes,
+        "degraded": True
+    }
+
+# Run detect, analyze and GPT for one frame. With emit(event, data), the
+# emotion analysis is sent as soon as it is known and GPT text is streamed.
+# Batch jobs pass priority=BACKGROUND so live requests go first. Live requests
+# pass their client_id so emotions are smoothed per viewer across frames, and
+# the local detector's boxes so faces still tracked from the previous frame
+# reuse its Face++ results instead of calling detect/analyze again.
+async def analyze_frame(jpeg, transform, api_key, api_secret, emit=None, priority=INTERACTIVE, client_id=None,
+                        boxes=None):
+    tracked = track_cache.lookup(client_id, boxes) if client_id is not None and boxes else None
+    if tracked is not None:
+        events_total.inc("track_hit")
+        analyze_result = {"faces": tracked}
+    else:
+        # Create a semaphore (per request, on the background loop)
+        semaphore = asyncio.Semaphore(config.facepp_concurrency)
+        session = await get_session()
+        try:
+            face_tokens = await detect_faces_async(jpeg, api_key, api_secret, session, semaphore, priority)
+            if not face_tokens:
+                return {'error': 'No faces detected'}
+
+            analyze_result = await analyze_in_batches(
+                lambda chunk: analyze_faces_async(chunk, api_key, api_secret, session, semaphore, priority),
+                face_tokens
+            )
+        except FaceppUnavailable:
+            return await analyze_frame_locally(jpeg, transform, emit, client_id)
+        if not analyze_result or not analyze_result['faces']:
+            return {'error': 'No faces detected or no emotion data available'}
+
+        if transform is not None:
+            for face in analyze_result['faces']:
+                if 'face_rectangle' in face:
+                    face['face_rectangle'] = restore_rectangle(face['face_rectangle'], transform)
+        if client_id is not None and boxes:
+            track_cache.store(client_id, boxes, analyze_result['faces'])
+    if emit is not None:
+        emit('analysis', {"emotion_analysis": analyze_result})
+
+    # One fortune per face, all requested in parallel; each viewer is keyed by
+    # its track across frames, not by its position in the Face++ result
+    faces = analyze_result['faces']
+    viewers = track_cache.identify(client_id, faces) if client_id is not None else [None] * len(faces)
+    fortunes = await asyncio.gather(*(
+        face_fortune(face, index, emit, (client_id, viewer) if viewer is not None else None)
+        for index, (face, viewer) in enumerate(zip(faces, viewers))
+    ))
+    answered = [fortune for fortune in fortunes if 'chat_response' in fortune]
+    if not answered:
+        return {
+            "emotion_analysis": analyze_result,
+            "dominant_emotion": fortunes[0]["dominant_emotion"],
+            "error": "Failed to get ChatGPT response"
+        }
+    result = {
+        "emotion_analysis": analyze_result,
+        "chat_response": answered[0]["chat_response"],
+        "fortunes": fortunes
+    }
+    if all(fortune.get('cached') for fortune in fortunes):
+        result["cached"] = True
+    if all(fortune.get('held') for fortune in fortunes):
+        result["held"] = True
+    if all(fortune.get('pooled') for fortune in fortunes):
+        result["pooled"] = True
+    if any(fortune.get('degraded') for fortune in fortunes):
+        result["degraded"] = True
+    if tracked is not None:
+        result["tracked"] = True
+    return result
+
 # Flask route to process the video frame
 @app.route('/process_frame', methods=['POST'])
 def process_frame():
     if 'frame' not in request.files:
         return jsonify({'error': 'No frame part'}), 400
 
-    frame = request.files['frame']
-    # Convert image file stream to numpy array
-    np_frame = cv2.imdecode(np.frombuffer(frame.read(), np.uint8), cv2.IMREAD_COLOR)
+    # API credentials come from the startup config
+    api_key, api_secret = config.facepp_api_key, config.facepp_api_secret
+    if not api_key or not api_secret:
+        return jsonify({'error': 'Face++ credentials not configured'}), 500
+
+    client_id = client_key()
+    jpeg, transform, boxes, gate, early_result = prepare_frame(request.files['frame'].read(), client_id)
+    if early_result is not None:
+        return jsonify(early_result)
+    if jpeg is None:
+        return jsonify({'error': 'Invalid image'}), 400
 
-    # Read API credentials
-    api_key_file = "api_key.txt"
-    api_secret_file = "api_secret.txt"
-    api_key, api_secret = read_credentials(api_key_file, api_secret_file)
+    # Run the async process function on the shared loop
+    future = submit_job(client_id, analyze_frame(jpeg, transform, api_key, api_secret,
+                                                 client_id=client_id, boxes=boxes))
+    try:
+        analyze_result = wait_for_job(client_id, future)
+    except ClientDisconnected:
+        events_total.inc("disconnected")
+        log.debug("Client disconnected, request cancelled")
+        return '', 499
 
-    # Process the frame
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+    # A superseded request's result belongs to the newer frame, which stores it itself
+    if analyze_result.get('superseded'):
+        events_total.inc("superseded")
+    else:
+        store_result(gate, analyze_result)
+    return jsonify(analyze_result)
 
-    # Create a semaphore
-    semaphore = asyncio.Semaphore(1)
+# Format one Server-Sent Event
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Streaming variant of /process_frame (Server-Sent Events):
+#   analysis - emotion analysis, as soon as Face++ returns
+#   token    - a piece of GPT text for face N
+#   result   - the final result, same shape as /process_frame
+@app.route('/process_frame/stream', methods=['POST'])
+def process_frame_stream():
+    if 'frame' not in request.files:
+        return jsonify({'error': 'No frame part'}), 400
+
+    # API credentials come from the startup config
+    api_key, api_secret = config.facepp_api_key, config.facepp_api_secret
+    if not api_key or not api_secret:
+        return jsonify({'error': 'Face++ credentials not configured'}), 500
+
+    client_id = client_key()
+    jpeg, transform, boxes, gate, early_result = prepare_frame(request.files['frame'].read(), client_id)
+    if early_result is not None:
+        return Response(sse('result', early_result), mimetype='text/event-stream')
+    if jpeg is None:
+        return jsonify({'error': 'Invalid image'}), 400
+
+    # Events are produced on the background loop and consumed by this thread
+    events = queue.Queue()
+
+    def emit(event, data):
+        events.put((event, data))
 
     async def process():
-        async with ClientSession() as session:
-            face_tokens = await detect_faces_async(np_frame, api_key, api_secret, session, semaphore)
-            if face_tokens:
-                analyze_result = await analyze_faces_async(face_tokens, api_key, api_secret, session, semaphore)
-                if analyze_result and 'faces' in analyze_result:
-                    for face in analyze_result['faces']:
-                        emotions = face['attributes'].get('emotion', {})
-                        dominant_emotion = max(emotions, key=emotions.get) if emotions else "N/A"
-
-                        # Add a message to ChatGPT
-                        emotion_text = (
-                            f"The dominant emotion detected is '{dominant_emotion}'. "
-                            f"The detailed emotions are: {emotions}. "
-                            "Please provide a personalized fortune-telling biscuit based on this information."
-                        )
-                        messages = [
-                        {"role": "system", "content": (
-                                 "You are a cool fortune teller. Based on detected emotions from a person's facial expressions, "
-                                 "offer a personalized fortune-telling biscuit. Examples:\n"
-                                 )},
-                        {"role": "user", "content": emotion_text}
-                        ]
-
-                        try:
-                            response = client.chat.completions.create(
-                                model="GPT-4",
-                                messages=messages
-                            )
-                            chat_response = response.choices[0].message.content
-                            print("[DEBUG] GPT Response Content:", chat_response)
-                            return {
-                                "emotion_analysis": analyze_result,
-                                "chat_response": chat_response
-                            }
-                        except Exception as e:
-                            print(f"[DEBUG] GPT API Exception: {e}")
-                            return {
-                                "emotion_analysis": analyze_result,
-                                "dominant_emotion": dominant_emotion,
-                                "error": "Failed to get ChatGPT response"
-                            }
-
-                return {'error': 'No faces detected or no emotion data available'}
+        result = await analyze_frame(jpeg, transform, api_key, api_secret, emit, client_id=client_id, boxes=boxes)
+        emit('result', result)
+        return result
+
+    # A newer frame from this session cancels this stream's work
+    future = submit_job(client_id, process())
+    # End of stream, also when the job is cancelled before it starts
+    future.add_done_callback(lambda _: emit(None, None))
+
+    def generate():
+        try:
+            while True:
+                event, data = events.get()
+                if event is None:
+                    break
+                yield sse(event, data)
+            if future.cancelled():
+                events_total.inc("superseded")
+                yield sse('result', {'error': 'Superseded by a newer frame', 'superseded': True})
+            elif future.exception() is None:
+                store_result(gate, future.result())
             else:
-                return {'error': 'No faces detected'}
+                yield sse('result', {'error': 'Failed to process frame'})
+        finally:
+            # Client went away mid-stream: stop the remote calls
+            if not future.done():
+                future.cancel()
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
+
+# How long the WebSocket loop waits for a frame before checking on the current job (seconds)
+WS_POLL = 0.05
+
+# WebSocket transport: the browser sends binary JPEG frames over one
+# connection and gets JSON messages {"event": ..., "data": ...} back, with the
+# same events as /process_frame/stream. One frame per connection is analyzed
+# at a time; a frame arriving meanwhile waits, replacing (dropping) any frame
+# already waiting, so a busy pipeline sheds load instead of queueing it.
+def frame_socket(ws):
+    api_key, api_secret = config.facepp_api_key, config.facepp_api_secret
+    client_id = client_key()
+    outbox = queue.Queue()  # Events produced on the background loop
+    current, gate, waiting = None, None, None
+    dropped = 0
+
+    def send(event, data):
+        ws.send(json.dumps({"event": event, "data": data}))
+
+    def start(data):
+        jpeg, transform, boxes, gate, early_result = prepare_frame(data, client_id)
+        if early_result is not None or jpeg is None:
+            send('result', early_result or {'error': 'Invalid image'})
+            return None, None
+
+        async def process():
+            result = await analyze_frame(jpeg, transform, api_key, api_secret,
+                                         lambda event, data: outbox.put((event, data)),
+                                         client_id=client_id, boxes=boxes)
+            outbox.put(('result', result))
+            return result
+
+        return submit_job(client_id, process()), gate
+
+    if not api_key or not api_secret:
+        send('result', {'error': 'Face++ credentials not configured'})
+        return
     try:
-        # Run the async process function
-        analyze_result = loop.run_until_complete(process())
-        return jsonify(analyze_result)
+        while True:
+            while not outbox.empty():
+                send(*outbox.get())
+            if current is not None and current.done():
+                while not outbox.empty():
+                    send(*outbox.get())
+                if current.cancelled():
+                    events_total.inc("superseded")
+                    send('result', {'error': 'Superseded by a newer frame', 'superseded': True})
+                elif current.exception() is not None:
+                    send('result', {'error': 'Failed to process frame'})
+                else:
+                    store_result(gate, current.result())
+                current = None
+            if current is None and waiting is not None:
+                (current, gate), waiting = start(waiting), None
+
+            data = ws.receive(timeout=WS_POLL)
+            if not isinstance(data, bytes):
+                continue  # Timeout, or a text message (not used)
+            if waiting is not None:
+                dropped += 1
+                events_total.inc("ws_dropped")
+                send('dropped', {"frames": dropped})
+            waiting = data
     finally:
-        loop.close()
+        # Connection closed: stop the remote calls for this client's frame
+        if current is not None and not current.done():
+            current.cancel()
+
+app.config.setdefault('SOCK_SERVER_OPTIONS', {'ping_interval': 25})
+Sock(app).route('/ws')(frame_socket)
+
 
-        
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
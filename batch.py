@@ -0,0 +1,147 @@
+import os
+import json
+import logging
+import time
+import asyncio
+import argparse
+import cv2
+import app
+from scheduler import BACKGROUND
+from image_executor import detect_faces, crop_and_encode, fit_and_encode
+
+log = logging.getLogger("fortune")  # Configured (INFO, or DEBUG with DEBUG_LOG=1) by app
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+# Frames from a directory of images: (id, frame_index, timestamp, frame)
+def image_frames(directory, done):
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS))
+    for index, name in enumerate(names):
+        if name in done:
+            continue
+        frame = cv2.imread(os.path.join(directory, name), cv2.IMREAD_COLOR)
+        if frame is None:
+            log.warning("Skipping unreadable image: %s", name)
+            continue
+        yield name, index, None, frame
+
+
+# Frames sampled from a video file at `rate` frames per second of footage
+def video_frames(path, rate, done):
+    cap = cv2.VideoCapture(path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    step = max(1, round(fps / rate))
+    index = 0
+    try:
+        while True:
+            # grab() skips a frame without decoding it
+            if not cap.grab():
+                break
+            if index % step == 0:
+                item_id = f"{os.path.basename(path)}#{index}"
+                if item_id not in done:
+                    ok, frame = cap.retrieve()
+                    if ok:
+                        yield item_id, index, index / fps, frame
+            index += 1
+    finally:
+        cap.release()
+
+
+# IDs already in the output file. Real observations count as done; transient
+# failures (throttling, GPT errors, outages) are retried when the job is resumed.
+def load_checkpoint(output):
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, 'r') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Partly written last line of an interrupted run
+            if app.is_final_result(record.get("result", {})):
+                done.add(record["id"])
+    return done
+
+
+# Shrink and encode a frame on the app's image pool, cropping to faces first
+# when the local filter is on. Returns (jpeg, transform), or (None, None) if
+# no face was found.
+def prepare(frame):
+    executor, quality = app.image_executor, app.config.frame_jpeg_quality
+    if app.face_filter is not None:
+        boxes = app.face_filter.count(executor.run("filter", detect_faces, frame))
+        if not boxes:
+            return None, None
+        return executor.run("encode", crop_and_encode, frame, boxes, quality)
+    return executor.run("encode", fit_and_encode, frame,
+                        app.config.frame_max_width, app.config.frame_max_height, quality)
+
+
+async def run_batch(source, output, rate, workers):
+    done = load_checkpoint(output)
+    if done:
+        log.info("Resuming: %s frames already done", len(done))
+    frames = image_frames(source, done) if os.path.isdir(source) else video_frames(source, rate, done)
+    api_key, api_secret = app.config.facepp_api_key, app.config.facepp_api_secret
+    if not api_key or not api_secret:
+        raise SystemExit("Face++ credentials not configured")
+
+    queue = asyncio.Queue(maxsize=workers * 2)
+    counts = {"processed": 0, "failed": 0}
+    start = time.perf_counter()
+
+    with open(output, 'a') as out:
+        # Read and decode frames in a thread, feeding the bounded queue
+        async def produce():
+            while True:
+                item = await asyncio.to_thread(next, frames, None)
+                if item is None:
+                    break
+                await queue.put(item)
+            for _ in range(workers):
+                await queue.put(None)
+
+        async def work():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                item_id, index, timestamp, frame = item
+                jpeg, transform = await asyncio.to_thread(prepare, frame)
+                if jpeg is None:
+                    result = {'error': 'No faces detected', 'filtered': True}
+                else:
+                    # Runs on the app's shared loop, behind live requests in the Face++ scheduler
+                    result = await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(
+                        app.analyze_frame(jpeg, transform, api_key, api_secret, priority=BACKGROUND), app.loop
+                    ))
+                record = {"id": item_id, "source": source, "frame": index, "timestamp": timestamp, "result": result}
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+                counts["processed"] += 1
+                if not app.is_final_result(result):
+                    counts["failed"] += 1
+
+        await asyncio.gather(produce(), *(work() for _ in range(workers)))
+
+    elapsed = time.perf_counter() - start
+    log.info("Processed %s frames (%s failed) in %.1f s, %.2f frames/s", counts['processed'], counts['failed'],
+             elapsed, counts['processed'] / max(elapsed, 1e-9))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze a directory of images or a video file offline")
+    parser.add_argument("source", help="directory of images or a video file")
+    parser.add_argument("--output", default="results.jsonl", help="JSONL output; also the resume checkpoint")
+    parser.add_argument("--rate", type=float, default=1.0, help="video frames sampled per second of footage")
+    parser.add_argument("--workers", type=int, default=8, help="frames in flight at once")
+    args = parser.parse_args()
+
+    asyncio.run(run_batch(args.source, args.output, args.rate, args.workers))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+import os
+import json
+import glob
+import time
+import random
+import asyncio
+import argparse
+import threading
+import numpy as np
+from aiohttp import web, ClientSession, FormData
+
+# Sample emotion scores returned by the stub analyze endpoint
+STUB_EMOTIONS = [
+    {"anger": 0.1, "disgust": 0.1, "fear": 0.1, "happiness": 99.0, "neutral": 0.5, "sadness": 0.1, "surprise": 0.1},
+    {"anger": 2.0, "disgust": 0.5, "fear": 1.0, "happiness": 3.0, "neutral": 80.0, "sadness": 12.0, "surprise": 1.5},
+    {"anger": 0.3, "disgust": 0.2, "fear": 4.0, "happiness": 10.0, "neutral": 5.5, "sadness": 0.0, "surprise": 80.0},
+]
+STUB_RECTANGLE = {"top": 10, "left": 10, "width": 100, "height": 100}
+
+
+# Local stand-ins for the Face++ detect/analyze endpoints and the Azure
+# chat-completions API, with injectable latency, errors and throttling.
+#   error_rate    - fraction of calls answered with HTTP 500
+#   throttle_rate - fraction answered as throttled (Face++: 403
+#                   CONCURRENCY_LIMIT_EXCEEDED, OpenAI: 429)
+def make_stub_app(latency, error_rate=0.0, throttle_rate=0.0, faces=1,
+                  gpt_latency=0.0, gpt_error_rate=0.0, gpt_throttle_rate=0.0):
+    calls = {}
+
+    # Returns an error response to inject, or None
+    def injected(kind, errors, throttles):
+        calls[kind] = calls.get(kind, 0) + 1
+        roll = random.random()
+        if roll < throttles:
+            calls[kind + "_throttled"] = calls.get(kind + "_throttled", 0) + 1
+            if kind == "gpt":
+                return web.json_response({"error": {"code": "429", "message": "Rate limit exceeded"}},
+                                         status=429, headers={"Retry-After": "1"})
+            return web.json_response({"error_message": "CONCURRENCY_LIMIT_EXCEEDED"}, status=403)
+        if roll < throttles + errors:
+            calls[kind + "_failed"] = calls.get(kind + "_failed", 0) + 1
+            return web.json_response({"error_message": "INTERNAL_ERROR"}, status=500)
+        return None
+
+    async def detect(request):
+        await request.post()
+        await asyncio.sleep(latency)
+        error = injected("detect", error_rate, throttle_rate)
+        if error is not None:
+            return error
+        return web.json_response({"faces": [{"face_token": f"stub-token-{i}", "face_rectangle": STUB_RECTANGLE}
+                                            for i in range(faces)]})
+
+    async def analyze(request):
+        data = await request.post()
+        await asyncio.sleep(latency)
+        error = injected("analyze", error_rate, throttle_rate)
+        if error is not None:
+            return error
+        result = [{"face_token": token, "face_rectangle": STUB_RECTANGLE,
+                   "attributes": {"emotion": random.choice(STUB_EMOTIONS)}}
+                  for token in data["face_tokens"].split(",")]
+        return web.json_response({"faces": result})
+
+    async def chat_completions(request):
+        body = await request.json()
+        await asyncio.sleep(gpt_latency)
+        error = injected("gpt", gpt_error_rate, gpt_throttle_rate)
+        if error is not None:
+            return error
+        text = "A stub fortune: good things come to those who benchmark."
+        base = {"id": "stub", "created": int(time.time()), "model": body.get("model", "stub")}
+        if not body.get("stream"):
+            return web.json_response(dict(base, object="chat.completion", choices=[
+                {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+            ], usage={"prompt_tokens": 50, "completion_tokens": 12, "total_tokens": 62}))
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in text.split(" "):
+            chunk = dict(base, object="chat.completion.chunk", choices=[
+                {"index": 0, "delta": {"content": word + " "}, "finish_reason": None}
+            ])
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    stub = web.Application(client_max_size=20 * 1024 * 1024)
+    stub.router.add_post("/facepp/v3/detect", detect)
+    stub.router.add_post("/facepp/v3/face/analyze", analyze)
+    stub.router.add_post("/openai/deployments/{deployment}/chat/completions", chat_completions)
+    stub["calls"] = calls
+    return stub
+
+
+# Start the stub server on its own loop/thread and return its base URL
+def start_stub_server(stub, host="127.0.0.1", port=0):
+    stub_loop = asyncio.new_event_loop()
+    started = threading.Event()
+    address = {}
+
+    async def serve():
+        runner = web.AppRunner(stub)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        address["port"] = site._server.sockets[0].getsockname()[1]
+        started.set()
+
+    threading.Thread(target=stub_loop.run_forever, daemon=True).start()
+    asyncio.run_coroutine_threadsafe(serve(), stub_loop)
+    started.wait()
+    return f"http://{host}:{address['port']}"
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(label, samples):
+    print(f"{label:<24} n={len(samples):<5} "
+          f"p50={percentile(samples, 50) * 1000:7.2f} ms  "
+          f"p99={percentile(samples, 99) * 1000:7.2f} ms")
+
+
+# One frame through detect + analyze, the same way process_frame does it
+async def one_frame(app_module, frame, session):
+    semaphore = asyncio.Semaphore(1)
+    face_tokens = await app_module.detect_faces_async(frame, "key", "secret", session, semaphore)
+    return await app_module.analyze_faces_async(face_tokens, "key", "secret", session, semaphore)
+
+
+# Old behaviour: new event loop and ClientSession for every frame
+def run_per_request(app_module, frame, frames):
+    samples = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        frame_loop = asyncio.new_event_loop()
+        try:
+            async def process():
+                async with ClientSession() as session:
+                    return await one_frame(app_module, frame, session)
+            frame_loop.run_until_complete(process())
+        finally:
+            frame_loop.close()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+# New behaviour: shared background loop and pooled session
+def run_shared(app_module, frame, frames):
+    samples = []
+    for _ in range(frames):
+        start = time.perf_counter()
+
+        async def process():
+            return await one_frame(app_module, frame, await app_module.get_session())
+        app_module.run_async(process())
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+# Synthetic camera-like frame: smooth gradient plus sensor noise
+def synthetic_frame(width, height):
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    base = np.stack([np.broadcast_to((x + y) / 2, (height, width)),
+                     np.broadcast_to(x, (height, width)),
+                     np.broadcast_to(y, (height, width))], axis=2)
+    noise = np.random.normal(0, 6, base.shape)
+    return np.clip(base + noise, 0, 255).astype(np.uint8)
+
+
+# Bytes on the wire and server CPU per frame: old decode/re-encode vs passthrough
+def run_upload(frames, width, height):
+    import cv2
+    from frame_codec import jpeg_size, decode_frame, reduce_factor, encode_frame
+
+    frame = synthetic_frame(width, height)
+    # Old browser upload: full camera resolution, default quality
+    full_upload = encode_frame(frame, 92)
+    # New browser upload: downscaled to 640x480 at quality 0.8
+    small_upload = encode_frame(cv2.resize(frame, (640, 480), interpolation=cv2.INTER_AREA), 80)
+
+    def measure(label, upload, handle):
+        start = time.process_time()
+        sent = 0
+        for _ in range(frames):
+            sent = len(handle(upload))
+        cpu_ms = (time.process_time() - start) * 1000 / frames
+        print(f"{label:<24} upload={len(upload):>8} B  to Face++={sent:>8} B  cpu={cpu_ms:6.2f} ms/frame")
+
+    # Old server path: full decode, then re-encode before the Face++ upload
+    measure("decode + re-encode", full_upload,
+            lambda data: cv2.imencode('.jpg', cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR))[1])
+
+    # New server path: header check and a reduced grayscale decode for the gate/filter
+    def passthrough(data):
+        size = jpeg_size(data)
+        decode_frame(data, grayscale=True, reduce=reduce_factor(size[0], 320))
+        return data
+    measure("passthrough", small_upload, passthrough)
+
+
+# Frames to send: JPEGs from a directory of recorded frames, or synthetic ones
+def load_corpus(frames_dir, count, width, height):
+    if frames_dir:
+        paths = sorted(glob.glob(os.path.join(frames_dir, "*.jpg")) + glob.glob(os.path.join(frames_dir, "*.jpeg")))
+        if not paths:
+            raise SystemExit(f"No .jpg frames found in {frames_dir}")
+        corpus = []
+        for path in paths:
+            with open(path, "rb") as file:
+                corpus.append(file.read())
+        return corpus
+    from frame_codec import encode_frame
+    return [encode_frame(synthetic_frame(width, height), 80) for _ in range(count)]
+
+
+# Start the Flask app on a local threaded server; returns its base URL
+def start_app_server(app_module, host="127.0.0.1"):
+    from werkzeug.serving import make_server
+    server = make_server(host, 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://{host}:{server.server_port}"
+
+
+# Drive the endpoint with `concurrency` clients until `requests` frames have been sent
+async def drive(url, corpus, requests, concurrency):
+    samples = []
+    first_bytes = []
+    outcomes = {}
+    sent = 0
+
+    async def client(client_id):
+        nonlocal sent
+        async with ClientSession() as http:
+            while sent < requests:
+                frame = corpus[sent % len(corpus)]
+                sent += 1
+                form = FormData()
+                form.add_field("frame", frame, filename="frame.jpg", content_type="image/jpeg")
+                form.add_field("client_id", f"load-{client_id}")
+                start = time.perf_counter()
+                try:
+                    async with http.post(url, data=form) as response:
+                        first = await response.content.readany()
+                        first_bytes.append(time.perf_counter() - start)
+                        body = first + await response.read()
+                        status = response.status
+                except Exception as e:
+                    outcomes[type(e).__name__] = outcomes.get(type(e).__name__, 0) + 1
+                    continue
+                samples.append(time.perf_counter() - start)
+                outcome = f"HTTP {status}"
+                if status == 200:
+                    text = body.decode(errors="replace")
+                    # Streaming responses end with a 'result' event holding the same JSON
+                    payload = json.loads(text.rsplit("data: ", 1)[-1]) if text.startswith("event:") else json.loads(text)
+                    outcome = payload.get("error", "ok")
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    return samples, first_bytes, outcomes, time.perf_counter() - start
+
+
+def run_load(args):
+    stub = make_stub_app(args.latency, args.error_rate, args.throttle_rate, args.faces,
+                         args.gpt_latency, args.gpt_error_rate, args.gpt_throttle_rate)
+    stub_url = start_stub_server(stub)
+
+    # Point the app at the stubs before it loads its config
+    os.environ.update({
+        "FACEPP_URL": stub_url + "/facepp/v3",
+        "FACEPP_API_KEY": "stub",
+        "FACEPP_API_SECRET": "stub",
+        "AZURE_KEY": "stub",
+        "AZURE_ENDPOINT": stub_url,
+        "FACEPP_QPS": str(args.qps),  # Measure the pipeline, not the rate limiter
+    })
+    if not args.local_filter:
+        os.environ["LOCAL_FACE_FILTER"] = "0"  # Synthetic frames contain no real faces
+    if not args.gate:
+        os.environ["FRAME_GATE_MAX_STALENESS"] = "0"  # Analyze every frame
+    if not args.cache:
+        os.environ["FORTUNE_CACHE_TTL"] = "0"  # Every fortune goes to the GPT stub
+        os.environ["WARM_POOL_SIZE"] = "0"
+    if not args.smoothing:
+        os.environ["EMOTION_COOLDOWN"] = "0"  # Every frame gets a new fortune
+    import app as app_module
+
+    url = start_app_server(app_module) + args.endpoint
+    corpus = load_corpus(args.frames_dir, 16, args.width, args.height)
+    samples, first_bytes, outcomes, elapsed = asyncio.run(drive(url, corpus, args.frames, args.concurrency))
+
+    print(f"{args.frames} requests to {args.endpoint}, concurrency {args.concurrency}, {elapsed:.2f} s")
+    print(f"throughput: {len(samples) / elapsed:.1f} req/s")
+    if samples:
+        print(f"latency:    p50={percentile(samples, 50) * 1000:.1f} ms  p95={percentile(samples, 95) * 1000:.1f} ms  "
+              f"p99={percentile(samples, 99) * 1000:.1f} ms")
+        print(f"first byte: p50={percentile(first_bytes, 50) * 1000:.1f} ms  "
+              f"p99={percentile(first_bytes, 99) * 1000:.1f} ms")
+    print("outcomes:")
+    for outcome, count in sorted(outcomes.items(), key=lambda item: -item[1]):
+        print(f"  {count:>6}  {outcome}")
+    print("stub calls:", json.dumps(stub["calls"], sort_keys=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-frame Face++ latency against a local stub server")
+    parser.add_argument("--suite", choices=["session", "upload", "load"], default="session",
+                        help="session: pooled vs per-request session latency; upload: bytes and CPU per frame; "
+                             "load: drive /process_frame against stub Face++ and OpenAI servers")
+    parser.add_argument("--frames", type=int, default=200, help="frames (requests) to send")
+    parser.add_argument("--latency", type=float, default=0.0, help="stub Face++ latency per call (seconds)")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--qps", type=float, default=1e6,
+                        help="FACEPP_QPS for the app's rate limiter (default: effectively unlimited)")
+
+    load = parser.add_argument_group("load suite")
+    load.add_argument("--endpoint", default="/process_frame", help="/process_frame or /process_frame/stream")
+    load.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    load.add_argument("--frames-dir", help="directory of recorded .jpg frames (default: synthetic frames)")
+    load.add_argument("--faces", type=int, default=1, help="faces returned per detect call")
+    load.add_argument("--error-rate", type=float, default=0.0, help="fraction of Face++ calls failing with 500")
+    load.add_argument("--throttle-rate", type=float, default=0.0,
+                      help="fraction of Face++ calls answered CONCURRENCY_LIMIT_EXCEEDED")
+    load.add_argument("--gpt-latency", type=float, default=0.0, help="stub GPT latency per call (seconds)")
+    load.add_argument("--gpt-error-rate", type=float, default=0.0, help="fraction of GPT calls failing with 500")
+    load.add_argument("--gpt-throttle-rate", type=float, default=0.0, help="fraction of GPT calls answered 429")
+    load.add_argument("--local-filter", action="store_true", help="keep the local face filter on (needs real faces)")
+    load.add_argument("--gate", action="store_true", help="keep the frame gate on")
+    load.add_argument("--cache", action="store_true", help="keep the fortune cache and warm pool on")
+    load.add_argument("--smoothing", action="store_true", help="keep per-viewer fortune holding on")
+    args = parser.parse_args()
+
+    if args.suite == "upload":
+        run_upload(args.frames, args.width, args.height)
+        return
+    if args.suite == "load":
+        run_load(args)
+        return
+
+    os.environ["FACEPP_URL"] = start_stub_server(make_stub_app(args.latency)) + "/facepp/v3"
+    os.environ["WARM_POOL_SIZE"] = "0"  # Only Face++ calls are measured here
+    os.environ["FACEPP_QPS"] = str(args.qps)
+    import app as app_module
+
+    frame = np.random.randint(0, 255, (args.height, args.width, 3), dtype=np.uint8)
+    report("per-request session", run_per_request(app_module, frame, args.frames))
+    report("shared pooled session", run_shared(app_module, frame, args.frames))
+
+
+if __name__ == "__main__":
+    main()
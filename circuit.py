@@ -0,0 +1,90 @@
+import time
+import threading
+from contextlib import contextmanager
+
+CLOSED = "closed"        # Calls go through
+OPEN = "open"            # Calls fail fast until reset_timeout has passed
+HALF_OPEN = "half_open"  # One probe call decides whether to close or re-open
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+# A dependency answered, but with a server-side error (e.g. HTTP 5xx)
+class RemoteError(Exception):
+    pass
+
+
+# Circuit breaker for one remote dependency. After failure_threshold
+# consecutive failures the circuit opens and calls fail fast instead of
+# waiting out timeouts; after reset_timeout seconds a single probe call is
+# let through, and its outcome closes or re-opens the circuit.
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0  # Consecutive failures
+        self.opened = 0.0
+        self.probing = False
+        self.trips = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    # Whether a call may go ahead now
+    def allow(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and now - self.opened >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self.probing = False
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, ok, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.probing = False
+            if ok:
+                self.state = CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.trips += 1
+                self.state = OPEN
+                self.opened = now
+
+    # A call that ended without an outcome (cancelled); lets another probe through
+    def abandon(self):
+        with self.lock:
+            self.probing = False
+
+    # Guard a block of remote calls (sync or around awaits): raises CircuitOpen
+    # while the circuit is open; any exception from the block counts as a failure
+    @contextmanager
+    def guard(self):
+        if not self.allow():
+            raise CircuitOpen(f"{self.name} circuit open")
+        try:
+            yield
+        except Exception:
+            self.record(False)
+            raise
+        except BaseException:
+            self.abandon()
+            raise
+        self.record(True)
+
+    def stats(self):
+        with self.lock:
+            return {"state": self.state, "failures": self.failures,
+                    "trips": self.trips, "rejected": self.rejected}
@@ -0,0 +1,33 @@
+import threading
+from collections import OrderedDict
+
+
+# Tracks the newest job (a concurrent.futures.Future) of each browser
+# session. Submitting a newer frame cancels the session's older job; anyone
+# still waiting on the old frame can pick up the newest job's result instead.
+class SessionJobs:
+    def __init__(self, max_sessions=1024):
+        self.max_sessions = max_sessions
+        self.jobs = OrderedDict()  # client_id -> future
+        self.superseded = 0
+        self.lock = threading.Lock()
+
+    def submit(self, client_id, future):
+        with self.lock:
+            old = self.jobs.pop(client_id, None)
+            self.jobs[client_id] = future
+            while len(self.jobs) > self.max_sessions:
+                self.jobs.popitem(last=False)
+        if old is not None and old.cancel():
+            with self.lock:
+                self.superseded += 1
+
+    # The newest job for this session (possibly already finished), or None
+    def latest(self, client_id):
+        with self.lock:
+            return self.jobs.get(client_id)
+
+    def stats(self):
+        with self.lock:
+            in_flight = sum(1 for future in self.jobs.values() if not future.done())
+            return {"in_flight": in_flight, "superseded": self.superseded}
@@ -0,0 +1,108 @@
+import os
+import logging
+
+log = logging.getLogger("fortune")
+
+
+# Function to read a secret from an environment variable, falling back to a file
+def read_secret(env_name, file_name):
+    value = os.getenv(env_name)
+    if value:
+        return value.strip()
+    try:
+        with open(file_name, 'r') as file:
+            return file.read().strip()
+    except OSError:
+        log.debug("%s not set and %s not readable", env_name, file_name)
+        return None
+
+
+# Application settings, read once from the environment and credential files.
+# The web app builds one at startup and replaces it on SIGHUP.
+class Config:
+    def __init__(self):
+        env = os.getenv
+
+        # Verbose request/response logging
+        self.debug_log = env("DEBUG_LOG", "0") == "1"
+
+        # Face++ credentials and endpoint (override the URL to point at a local stub server)
+        self.facepp_api_key = read_secret("FACEPP_API_KEY", env("FACEPP_API_KEY_FILE", "api_key.txt"))
+        self.facepp_api_secret = read_secret("FACEPP_API_SECRET", env("FACEPP_API_SECRET_FILE", "api_secret.txt"))
+        self.facepp_url = env("FACEPP_URL", "https://api-us.faceplusplus.com/facepp/v3")
+
+        # Max concurrent Face++ calls within one request (e.g. analyze batches)
+        self.facepp_concurrency = int(env("FACEPP_CONCURRENCY", "2"))
+
+        # Process-wide Face++ rate limit (token bucket) and retries on throttling errors
+        self.facepp_qps = max(0.0, float(env("FACEPP_QPS", "10")))  # 0 = unlimited
+        self.facepp_burst = float(env("FACEPP_BURST", "0")) or None  # Defaults to one second of QPS
+        self.facepp_max_retries = int(env("FACEPP_MAX_RETRIES", "3"))
+
+        # Per-call Face++ timeout (seconds), and the circuit breaker: consecutive
+        # failures before calls fail fast, and seconds before a probe call
+        self.facepp_timeout = float(env("FACEPP_TIMEOUT", "10"))
+        self.facepp_breaker_failures = int(env("FACEPP_BREAKER_FAILURES", "5"))
+        self.facepp_breaker_reset = float(env("FACEPP_BREAKER_RESET", "30"))
+
+        # Connection pool settings for the shared Face++ session
+        self.pool_limit = int(env("FACEPP_POOL_LIMIT", "20"))
+        self.pool_limit_per_host = int(env("FACEPP_POOL_LIMIT_PER_HOST", "10"))
+        self.dns_cache_ttl = int(env("FACEPP_DNS_CACHE_TTL", "300"))
+        self.keepalive_timeout = float(env("FACEPP_KEEPALIVE_TIMEOUT", "30"))
+
+        # Azure OpenAI
+        self.azure_key = env("AZURE_KEY")
+        self.azure_endpoint = env("AZURE_ENDPOINT")
+        self.azure_api_version = env("AZURE_API_VERSION", "2023-10-01-preview")
+        self.gpt_model = env("GPT_MODEL", "GPT-4")
+        self.gpt_concurrency = int(env("GPT_CONCURRENCY", "4"))
+        self.gpt_timeout = float(env("GPT_TIMEOUT", "30"))
+        self.gpt_breaker_failures = int(env("GPT_BREAKER_FAILURES", "3"))
+        self.gpt_breaker_reset = float(env("GPT_BREAKER_RESET", "30"))
+
+        # Fortune cache (bucket size is in Face++ emotion score points, 0-100)
+        self.fortune_cache_size = int(env("FORTUNE_CACHE_SIZE", "256"))
+        self.fortune_cache_ttl = float(env("FORTUNE_CACHE_TTL", "600"))
+        self.fortune_bucket_size = float(env("FORTUNE_BUCKET_SIZE", "20"))
+        self.fortune_pool_size = int(env("FORTUNE_POOL_SIZE", "3"))
+        self.fortune_cache_path = env("FORTUNE_CACHE_PATH")
+
+        # Warm pool of pre-generated fortunes: fortunes per emotion/intensity slot
+        # (0 disables), GPT calls per hour for refills, and the file it is kept in
+        self.warm_pool_size = int(env("WARM_POOL_SIZE", "5"))
+        self.warm_pool_budget = int(env("WARM_POOL_BUDGET", "60"))
+        self.warm_pool_path = env("WARM_POOL_PATH", "warm_pool.json")
+
+        # Per-viewer emotion smoothing: EMA weight of the newest frame, seconds before
+        # the same dominant emotion gets a fresh fortune, and GPT exchanges kept as context
+        self.emotion_smoothing = float(env("EMOTION_SMOOTHING", "0.4"))
+        self.emotion_cooldown = float(env("EMOTION_COOLDOWN", "30"))
+        self.emotion_context_turns = int(env("EMOTION_CONTEXT_TURNS", "2"))
+
+        # Local face detection before calling Face++
+        self.local_face_filter = env("LOCAL_FACE_FILTER", "1") == "1"
+        self.local_filter_max_side = int(env("LOCAL_FILTER_MAX_SIDE", "640"))
+
+        # Face++ result reuse for faces tracked across frames: seconds before a
+        # fresh analysis (0 disables), and overlap needed to count as the same face
+        self.track_ttl = float(env("TRACK_TTL", "10"))
+        self.track_min_iou = float(env("TRACK_MIN_IOU", "0.5"))
+
+        # Browser sessions remembered by each per-client store (frame gates, in-flight
+        # jobs, emotion states, face tracks); FRAME_GATE_SESSIONS is the old name
+        self.max_client_sessions = int(env("MAX_CLIENT_SESSIONS", env("FRAME_GATE_SESSIONS", "256")))
+
+        # Per-client scene-change gate
+        self.frame_gate_threshold = float(env("FRAME_GATE_THRESHOLD", "6"))
+        self.frame_gate_max_staleness = float(env("FRAME_GATE_MAX_STALENESS", "30"))
+
+        # Where image decode/filter/encode runs: inline, thread or process (fork only),
+        # and how many workers (defaults to one per core)
+        self.image_executor = env("IMAGE_EXECUTOR", "thread")
+        self.image_workers = int(env("IMAGE_WORKERS", "0")) or None
+
+        # Upload size and quality negotiated with the browser
+        self.frame_max_width = int(env("FRAME_MAX_WIDTH", "640"))
+        self.frame_max_height = int(env("FRAME_MAX_HEIGHT", "480"))
+        self.frame_jpeg_quality = int(env("FRAME_JPEG_QUALITY", "80"))
@@ -0,0 +1,101 @@
+import time
+import threading
+from collections import OrderedDict, deque
+import numpy as np
+from fortune_cache import EMOTIONS
+
+
+# Last few prompt/fortune exchanges, sent along with the next GPT request
+# so fortunes follow on from each other without resending the whole history
+class ContextWindow:
+    def __init__(self, turns=2):
+        self.turns = deque(maxlen=turns)  # (user message, assistant message)
+        self.lock = threading.Lock()
+
+    def add(self, prompt, reply):
+        with self.lock:
+            self.turns.append((prompt, reply))
+
+    def messages(self):
+        with self.lock:
+            turns = list(self.turns)
+        messages = []
+        for prompt, reply in turns:
+            messages.append({"role": "user", "content": prompt})
+            messages.append({"role": "assistant", "content": reply})
+        return messages
+
+
+# Smoothed emotion state of one viewer: an exponential moving average of
+# the 7 Face++ emotion scores. A new fortune is due only when the smoothed
+# dominant emotion changes or the last fortune is older than the cooldown.
+class EmotionState:
+    def __init__(self, alpha=0.4, cooldown=30.0, context_turns=2):
+        self.alpha = alpha        # Weight of the newest observation (1.0 = no smoothing)
+        self.cooldown = cooldown  # Seconds before the same emotion gets a fresh fortune
+        self.scores = None        # float32 scores in EMOTIONS order
+        self.dominant = None      # Smoothed dominant emotion the last fortune was for
+        self.fortune = None
+        self.updated = 0.0
+        self.context = ContextWindow(context_turns)
+        self.lock = threading.Lock()
+
+    # Fold in one observation. Returns (smoothed emotions, dominant emotion, due)
+    def update(self, emotions, now=None):
+        now = time.monotonic() if now is None else now
+        observed = np.array([emotions.get(name, 0.0) for name in EMOTIONS], dtype=np.float32)
+        with self.lock:
+            if self.scores is None:
+                self.scores = observed
+            else:
+                self.scores += self.alpha * (observed - self.scores)
+            dominant = EMOTIONS[int(np.argmax(self.scores))]
+            due = (self.dominant is None or dominant != self.dominant
+                   or now - self.updated >= self.cooldown)
+            smoothed = {name: round(float(score), 3) for name, score in zip(EMOTIONS, self.scores)}
+        return smoothed, dominant, due
+
+    # Record the fortune given for a dominant emotion; restarts the cooldown
+    def refreshed(self, dominant, fortune, now=None):
+        with self.lock:
+            self.dominant = dominant
+            self.fortune = fortune
+            self.updated = time.monotonic() if now is None else now
+
+    # Restart the cooldown for a dominant emotion whose fortune is still being
+    # written, so frames arriving meanwhile don't ask for another one
+    def hold(self, dominant, now=None):
+        with self.lock:
+            self.dominant = dominant
+            self.updated = time.monotonic() if now is None else now
+
+
+# One EmotionState per viewer, least recently seen viewers dropped first
+class EmotionStates:
+    def __init__(self, max_viewers=256, **state_options):
+        self.max_viewers = max_viewers
+        self.state_options = state_options
+        self.states = OrderedDict()
+        self.refreshed = 0
+        self.held = 0
+        self.lock = threading.Lock()
+
+    def get(self, viewer):
+        with self.lock:
+            state = self.states.pop(viewer, None) or EmotionState(**self.state_options)
+            self.states[viewer] = state
+            while len(self.states) > self.max_viewers:
+                self.states.popitem(last=False)
+            return state
+
+    # Count whether a frame produced a new fortune or kept the previous one
+    def count(self, due):
+        with self.lock:
+            if due:
+                self.refreshed += 1
+            else:
+                self.held += 1
+
+    def stats(self):
+        with self.lock:
+            return {"viewers": len(self.states), "refreshed": self.refreshed, "held": self.held}
@@ -0,0 +1,96 @@
+import threading
+import cv2
+
+
+# Local (CPU-only) face detection in front of the Face++ detect call.
+# Frames without a face are dropped before any network traffic; frames
+# with faces are cropped to the face region and downscaled.
+class LocalFaceFilter:
+    def __init__(self, detect_width=320, margin=0.3, max_side=640, min_face=48,
+                 scale_factor=1.1, min_neighbors=5):
+        self.detect_width = detect_width  # Width the frame is shrunk to for Haar detection
+        self.margin = margin              # Extra border around the faces, as a fraction of the box size
+        self.max_side = max_side          # Longest side of the image sent to Face++
+        self.min_face = min_face          # Face++ needs faces of at least 48px
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.cascade = None  # Loaded on first use
+        self.frames = 0
+        self.filtered = 0
+        self.lock = threading.Lock()
+
+    # Whether this OpenCV build has the Haar cascade detector (OpenCV 5 dropped it)
+    @staticmethod
+    def available():
+        return hasattr(cv2, "CascadeClassifier")
+
+    # Return face boxes (x, y, w, h) in full-frame coordinates. The frame may be
+    # BGR or grayscale; reduce is how much it was already shrunk while decoding.
+    def detect(self, frame, reduce=1):
+        if self.cascade is None:
+            self.cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+        height, width = frame.shape[:2]
+        scale = min(1.0, self.detect_width / width)
+        small = cv2.resize(frame, (int(width * scale), int(height * scale))) if scale < 1.0 else frame
+        gray = small if small.ndim == 2 else cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        min_size = max(8, int(self.min_face * scale / reduce))
+        boxes = self.cascade.detectMultiScale(gray, scaleFactor=self.scale_factor,
+                                              minNeighbors=self.min_neighbors,
+                                              minSize=(min_size, min_size))
+        return [tuple(int(v * reduce / scale) for v in box) for box in boxes]
+
+    # Detect and count; returns the face boxes (empty if the frame was filtered out)
+    def check(self, frame, reduce=1):
+        return self.count(self.detect(frame, reduce))
+
+    # Count the outcome of a detect() that ran elsewhere (e.g. in an image worker)
+    def count(self, boxes):
+        with self.lock:
+            self.frames += 1
+            if not boxes:
+                self.filtered += 1
+        return boxes
+
+    # Crop to the union of the face boxes plus margin, then downscale.
+    # Returns the new image and (left, top, scale) to map results back.
+    def crop(self, frame, boxes):
+        height, width = frame.shape[:2]
+        left = min(x for x, _, _, _ in boxes)
+        top = min(y for _, y, _, _ in boxes)
+        right = max(x + w for x, _, w, _ in boxes)
+        bottom = max(y + h for _, y, _, h in boxes)
+        pad_x = int((right - left) * self.margin)
+        pad_y = int((bottom - top) * self.margin)
+        left, top = max(0, left - pad_x), max(0, top - pad_y)
+        right, bottom = min(width, right + pad_x), min(height, bottom + pad_y)
+        region = frame[top:bottom, left:right]
+
+        # Don't shrink the smallest face below what Face++ can detect
+        smallest = min(min(w, h) for _, _, w, h in boxes)
+        scale = min(1.0, max(self.max_side / max(region.shape[:2]), self.min_face / smallest))
+        if scale < 1.0:
+            region = cv2.resize(region, (int(region.shape[1] * scale), int(region.shape[0] * scale)),
+                                interpolation=cv2.INTER_AREA)
+        return region, (left, top, scale)
+
+    # Returns (image, transform) to upload, or (None, None) if no face was found
+    def process(self, frame):
+        boxes = self.check(frame)
+        if not boxes:
+            return None, None
+        return self.crop(frame, boxes)
+
+    def stats(self):
+        with self.lock:
+            return {"frames": self.frames, "filtered": self.filtered}
+
+
+# Map a Face++ face_rectangle from the cropped image back to the original frame
+def restore_rectangle(rect, transform):
+    left, top, scale = transform
+    return {
+        "left": int(rect["left"] / scale) + left,
+        "top": int(rect["top"] / scale) + top,
+        "width": int(rect["width"] / scale),
+        "height": int(rect["height"] / scale),
+    }
@@ -1,173 +1,317 @@
-from openai import AzureOpenAI
-import os
-import requests
-import json
+from openai import AsyncAzureOpenAI
+import time
+import logging
 import cv2
 import asyncio
-from aiohttp import ClientSession, FormData
+from aiohttp import ClientSession, ClientTimeout, FormData
+from scheduler import Scheduler, INTERACTIVE
+from frame_gate import FrameGate
+from fortuneteller import analyze_in_batches
+from frame_codec import encode_frame
+from image_executor import ImageExecutor, detect_faces
+from face_filter import LocalFaceFilter
+from circuit import CircuitBreaker, RemoteError
+from fallback import canned_fortune
+from emotion_state import ContextWindow, EmotionStates
+from track_cache import TrackCache
+from config import Config
 
-# Semaphore to limit concurrent requests
-semaphore = asyncio.Semaphore(1)
+# Same settings and credentials as the web app (see config.py)
+config = Config()
 
-# Initialize Azure OpenAI client
-client = AzureOpenAI(
-    api_key=os.getenv("AZURE_KEY"),
-    azure_endpoint=os.getenv("AZURE_ENDPOINT"),
-    api_version="2023-10-01-preview"
+# Debug logging (DEBUG_LOG=1)
+logging.basicConfig(format="[%(levelname)s] %(message)s")
+log = logging.getLogger("fortune")
+log.setLevel(logging.DEBUG if config.debug_log else logging.INFO)
+
+# Process-wide Face++ rate limiter (token bucket, backs off on throttling errors)
+scheduler = Scheduler(qps=config.facepp_qps, burst=config.facepp_burst)
+
+# After repeated Face++ failures (timeouts, 5xx) a breaker makes calls fail
+# fast; the preview then counts faces locally until Face++ is back
+facepp_breaker = CircuitBreaker("facepp", config.facepp_breaker_failures, config.facepp_breaker_reset)
+gpt_breaker = CircuitBreaker("gpt", config.gpt_breaker_failures, config.gpt_breaker_reset)
+
+# Initialize Azure OpenAI client (non-blocking, so the preview keeps running during GPT calls)
+async_client = AsyncAzureOpenAI(
+    api_key=config.azure_key,
+    azure_endpoint=config.azure_endpoint,
+    api_version=config.azure_api_version,
+    timeout=config.gpt_timeout,
+    max_retries=0  # One attempt per call, so GPT_TIMEOUT bounds it and the breaker sees every failure
+)
+gpt_semaphore = asyncio.Semaphore(config.gpt_concurrency)
+
+# Resize, JPEG encoding and offline face detection run on a thread pool so
+# they don't stall the event loop
+image_executor = ImageExecutor(
+    mode=config.image_executor,
+    workers=config.image_workers,
+    face_filter=LocalFaceFilter(max_side=config.local_filter_max_side)
 )
 
-# Initial system message for GPT
-messages = [
-    {"role": "system", "content": "Describe the current emotions based on face features, and write current feelings in a second view. Give me the potential guess about the reason of emotion the people who is detcting, using 'you' to call the charater'. And give back a fortune-telling biscuit to the person based on their facial emotions."}
-]
-
-# Function to read API credentials
-def read_credentials(api_key_file, api_secret_file):
-    with open(api_key_file, 'r') as file:
-        api_key = file.read().strip()
-    with open(api_secret_file, 'r') as file:
-        api_secret = file.read().strip()
-    return api_key, api_secret
-
-# Function to detect faces
-async def detect_faces_async(frame, api_key, api_secret, session):
-    async with semaphore:
-        url = "https://api-us.faceplusplus.com/facepp/v3/detect"
-        _, img_encoded = cv2.imencode('.jpg', frame)
-
-        # Prepare the request
+# System message for GPT; each request adds only the last few exchanges
+system_message = {"role": "system", "content": "Describe the current emotions based on face features, and write current feelings in a second view. Give me the potential guess about the reason of emotion the people who is detcting, using 'you' to call the charater'. And give back a fortune-telling biscuit to the person based on their facial emotions."}
+
+# Function to detect faces: the face tokens ([] if none), or None if Face++
+# answered with an error. Network errors, timeouts and 5xx responses propagate.
+async def detect_faces_async(frame, api_key, api_secret, session, priority=INTERACTIVE):
+    url = config.facepp_url + "/detect"
+    img_bytes = await image_executor.run_async("encode", encode_frame, frame, 95)  # OpenCV's default quality
+
+    # Prepare the request
+    def make_form():
         form = FormData()
-        form.add_field("image_file", img_encoded.tobytes(), filename="frame.jpg", content_type="image/jpeg")
+        form.add_field("image_file", img_bytes, filename="frame.jpg", content_type="image/jpeg")
         form.add_field("api_key", api_key)
         form.add_field("api_secret", api_secret)
+        return form
 
-        try:
-            async with session.post(url, data=form) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    print(f"[DEBUG] Detect Faces Response: {result}")
-
-                    if 'faces' in result and result['faces']:
-                        face_tokens = [face['face_token'] for face in result['faces']]
-                        print(f"[DEBUG] Retrieved Face Tokens: {face_tokens}")
-                        return face_tokens
-                else:
-                    error_text = await response.text()
-                    print(f"[DEBUG] Detect Faces Error: {response.status} - {error_text}")
-        except Exception as e:
-            print(f"[DEBUG] Detect Faces Exception: {e}")
+    with facepp_breaker.guard():
+        status, result = await scheduler.post(session, url, make_form, priority,
+                                               timeout=ClientTimeout(total=config.facepp_timeout))
+        if status >= 500:
+            raise RemoteError(f"{status} - {result}")
+    if status == 200:
+        log.debug("Detect Faces Response: %s", result)
+
+        face_tokens = [face['face_token'] for face in result.get('faces', [])]
+        log.debug("Retrieved Face Tokens: %s", face_tokens)
+        return face_tokens
+    log.warning("Detect Faces Error: %s - %s", status, result)
     return None
 
 # Function to analyze faces
-async def analyze_faces_async(face_tokens, api_key, api_secret, session):
-    async with semaphore:
-        url = "https://api-us.faceplusplus.com/facepp/v3/face/analyze"
+async def analyze_faces_async(face_tokens, api_key, api_secret, session, priority=INTERACTIVE):
+    url = config.facepp_url + "/face/analyze"
 
-        # Prepare the request payload
-        request_payload = {
-            "api_key": api_key,
-            "api_secret": api_secret,
-            "face_tokens": ",".join(face_tokens),
-            "return_attributes": "emotion"  # Valid attributes
-        }
+    # Prepare the request payload
+    request_payload = {
+        "api_key": api_key,
+        "api_secret": api_secret,
+        "face_tokens": ",".join(face_tokens),
+        "return_attributes": "emotion"  # Valid attributes
+    }
 
-        print(f"[DEBUG] Sending Face Tokens for Analysis: {face_tokens}")
+    log.debug("Sending Face Tokens for Analysis: %s", face_tokens)
 
-        try:
-            async with session.post(url, data=request_payload) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    print(f"[DEBUG] Analyze Faces Response: {result}")
-                    return result
-                else:
-                    error_text = await response.text()
-                    print(f"[DEBUG] Analyze Faces Error: {response.status} - {error_text}")
-        except Exception as e:
-            print(f"[DEBUG] Analyze Faces Exception: {e}")
+    with facepp_breaker.guard():
+        status, result = await scheduler.post(session, url, lambda: request_payload, priority,
+                                               timeout=ClientTimeout(total=config.facepp_timeout))
+        if status >= 500:
+            raise RemoteError(f"{status} - {result}")
+    if status == 200:
+        log.debug("Analyze Faces Response: %s", result)
+        return result
+    log.warning("Analyze Faces Error: %s - %s", status, result)
     return None
 
-# Retry mechanism with exponential backoff
-async def retry_on_error(coro_func, retries=3, delay=2):
-    for attempt in range(retries):
+# Ask GPT in the background; the capture loop does not wait for it.
+# Only the last few exchanges in context are sent along with the prompt.
+async def fortune_async(prompt, context):
+    messages = [system_message, *context.messages(), {"role": "user", "content": prompt}]
+    async with gpt_semaphore:
         try:
-            return await coro_func()
+            with gpt_breaker.guard():
+                response = await async_client.chat.completions.create(
+                    model=config.gpt_model,
+                    messages=messages
+                )
+            gpt_response = response.choices[0].message.content
+            log.debug("GPT Response: %s", gpt_response)
+            context.add(prompt, gpt_response)
+            return gpt_response
         except Exception as e:
-            print(f"[DEBUG] Retry ({attempt + 1}/{retries}) after error: {e}")
-            await asyncio.sleep(delay * (2 ** attempt))
-    print("[DEBUG] All retries failed.")
-    return None
+            log.warning("GPT API Exception: %s", e)
+    gpt_response = canned_fortune()
+    log.info("Canned fortune (degraded): %s", gpt_response)
+    return gpt_response
 
-# Video processing function
-async def video_emotion_analysis(api_key, api_secret):
-    cap = cv2.VideoCapture(0)
-    frame_count = 0
-    frame_interval = 60  # Process one frame every 60 frames (approximately 2 seconds for 30 FPS)
+# Record a finished fortune for the viewers it was written for, unless their
+# dominant emotion has changed since (a newer fortune is then on its way)
+def record_fortune(task, held):
+    if task.cancelled():
+        return
+    fortune = task.result()
+    for state, dominant in held:
+        if state.dominant == dominant:
+            state.refreshed(dominant, fortune)
 
-    async with ClientSession() as session:
+# Size-1 "latest frame" slot: putting a frame replaces any unread one
+class LatestFrame:
+    def __init__(self):
+        self.frame = None
+        self.ready = asyncio.Event()
+        self.dropped = 0  # Frames replaced before the worker picked them up
+
+    def put(self, frame):
+        if self.frame is not None:
+            self.dropped += 1
+        self.frame = frame
+        self.ready.set()
+
+    async def get(self):
+        await self.ready.wait()
+        self.ready.clear()
+        frame, self.frame = self.frame, None
+        return frame
+
+
+# Events per second over a sliding window
+class RateMeter:
+    def __init__(self, window=5.0):
+        self.window = window
+        self.times = []
+
+    def tick(self):
+        now = time.monotonic()
+        self.times.append(now)
+        while self.times and now - self.times[0] > self.window:
+            self.times.pop(0)
+
+    def rate(self):
+        if len(self.times) < 2:
+            return 0.0
+        return (len(self.times) - 1) / (self.times[-1] - self.times[0])
+
+
+# Analysis worker: takes the newest frame, runs Face++ and updates the overlay
+async def analysis_worker(slot, overlay, api_key, api_secret, session, analysis_interval, analysis_rate):
+    gate = FrameGate()  # Skip analysis while the scene is unchanged
+    # Smoothed emotions per face, tracked across frames by position (not by the
+    # size order Face++ returns); GPT sees a bounded window of past exchanges
+    tracks = TrackCache(max_clients=1)
+    states = EmotionStates(alpha=config.emotion_smoothing, cooldown=config.emotion_cooldown, context_turns=0)
+    context = ContextWindow(config.emotion_context_turns)
+    gpt_tasks = set()  # In-flight GPT requests
+    try:
         while True:
-            ret, frame = cap.read()
-            if not ret:
-                print("Failed to capture frame. Exiting...")
-                break
-
-            frame = cv2.resize(frame, (320, 240))
-            frame_count += 1
-            emotion_text = "Analyzing..."
-
-            # Process frames only at the specified interval
-            if frame_count % frame_interval == 0:
-                print("[DEBUG] Processing frame...")
-                face_tokens = await retry_on_error(
-                    lambda: detect_faces_async(frame, api_key, api_secret, session)
-                )
+            frame = await slot.get()
+            changed, last_text = gate.check(frame)
+            if not changed:
+                overlay["text"] = last_text
+                continue
 
+            log.debug("Processing frame...")
+            # No retries or backoff here: throttling is retried by the scheduler, and
+            # timeouts and 5xx errors count against the breaker, which fails fast once open
+            face_tokens, analyze_result = None, None
+            try:
+                face_tokens = await detect_faces_async(frame, api_key, api_secret, session)
                 if face_tokens:
-                    analyze_result = await retry_on_error(
-                        lambda: analyze_faces_async(face_tokens, api_key, api_secret, session)
+                    analyze_result = await analyze_in_batches(
+                        lambda chunk: analyze_faces_async(chunk, api_key, api_secret, session),
+                        face_tokens
                     )
+            except Exception as e:
+                log.warning("Face++ failed: %s", e)
+            if face_tokens is None or (face_tokens and analyze_result is None):
+                # Face++ failed or is down: count faces locally; the result is not stored in the gate
+                boxes = (await image_executor.run_async("filter", detect_faces, frame)
+                         if LocalFaceFilter.available() else [])
+                overlay["text"] = f"Offline: {len(boxes)} face(s)"
+                if boxes:
+                    log.info("Canned fortune (degraded): %s", canned_fortune())
+                await asyncio.sleep(analysis_interval)
+                continue
 
-                    if analyze_result and 'faces' in analyze_result:
-                        emotions = analyze_result['faces'][0]['attributes']['emotion']
-                        dominant_emotion = max(emotions, key=emotions.get)
-                        emotion_text = f"Emotion: {dominant_emotion}"
-
-                        # Pass to OpenAI GPT
-                        gpt_message = {"role": "user", "content": emotion_text}
-                        messages.append(gpt_message)
-
-                        try:
-                            response = client.chat.completions.create(
-                                model="GPT-4",
-                                messages=messages
-                            )
-                            gpt_response = response.choices[0].message.content
-                            print("[DEBUG] GPT Response:", gpt_response)
-
-                        except Exception as e:
-                            print(f"[DEBUG] GPT API Exception: {e}")
+            if face_tokens:
+                if analyze_result['faces']:
+                    # Smoothed dominant emotion of every face, sent to GPT in one combined prompt
+                    dominant_emotions = []
+                    due = False
+                    viewers = tracks.identify("camera", analyze_result['faces'])
+                    for viewer, face in zip(viewers, analyze_result['faces']):
+                        _, dominant, face_due = states.get(viewer).update(face['attributes']['emotion'])
+                        dominant_emotions.append(dominant)
+                        due = due or face_due
+                    if len(dominant_emotions) == 1:
+                        emotion_text = f"Emotion: {dominant_emotions[0]}"
                     else:
-                        emotion_text = "No emotion data available"
+                        emotion_text = "Emotions: " + ", ".join(dominant_emotions)
+
+                    # Pass to OpenAI GPT only when an emotion changed or the cooldown expired
+                    states.count(due)
+                    if due:
+                        # Restart the cooldowns now; GPT answers in the background
+                        held = [(states.get(viewer), dominant) for viewer, dominant in zip(viewers, dominant_emotions)]
+                        for state, dominant in held:
+                            state.hold(dominant)
+                        task = asyncio.create_task(fortune_async(emotion_text, context))
+                        gpt_tasks.add(task)
+                        task.add_done_callback(gpt_tasks.discard)
+                        task.add_done_callback(lambda task, held=held: record_fortune(task, held))
                 else:
-                    emotion_text = "No faces detected"
+                    emotion_text = "No emotion data available"
+            else:
+                emotion_text = "No faces detected"
+
+            gate.store(emotion_text)
+            overlay["text"] = emotion_text
+            analysis_rate.tick()
+
+            # Minimum spacing between analyses; the preview keeps running meanwhile
+            await asyncio.sleep(analysis_interval)
+    finally:
+        for task in list(gpt_tasks):
+            task.cancel()
+
+
+# Video processing function: the capture loop renders at camera FPS while
+# a single analysis worker picks up only the newest frame
+async def video_emotion_analysis(api_key, api_secret, analysis_interval=2.0):
+    cap = cv2.VideoCapture(0)
+    slot = LatestFrame()
+    overlay = {"text": "Analyzing..."}
+    display_rate = RateMeter()
+    analysis_rate = RateMeter(window=30.0)
+
+    async with ClientSession() as session:
+        worker = asyncio.create_task(
+            analysis_worker(slot, overlay, api_key, api_secret, session, analysis_interval, analysis_rate)
+        )
+        try:
+            while True:
+                # Read in a thread so the worker and GPT tasks keep running
+                ret, frame = await asyncio.to_thread(cap.read)
+                if not ret:
+                    log.error("Failed to capture frame. Exiting...")
+                    break
 
-                # Introduce a delay to slow down processing
-                await asyncio.sleep(2)  # Add a 2-second delay between detections
+                frame = await image_executor.run_async("resize", cv2.resize, frame, (320, 240))
+                slot.put(frame)
+                display_rate.tick()
 
-            # Display emotion text on the video feed
-            cv2.putText(frame, emotion_text, (10, 50),
-                        cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-            cv2.imshow("Emotion Analysis", frame)
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                break
+                # Display emotion text on a copy so the worker gets a clean frame
+                display = frame.copy()
+                cv2.putText(display, overlay["text"], (10, 50),
+                            cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+                cv2.putText(display, f"FPS {display_rate.rate():.1f}  analysis {analysis_rate.rate():.2f}/s",
+                            (10, 230), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 0), 1)
+                cv2.imshow("Emotion Analysis", display)
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+        finally:
+            worker.cancel()
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
 
+    log.info("Display FPS: %.1f, analysis rate: %.2f/s, dropped frames: %s",
+             display_rate.rate(), analysis_rate.rate(), slot.dropped)
+    log.debug("Image stages: %s", image_executor.stats()['stages'])
     cap.release()
     cv2.destroyAllWindows()
+    image_executor.close()
+    return {"display_fps": display_rate.rate(), "analysis_rate": analysis_rate.rate(), "dropped_frames": slot.dropped,
+            "image_stages": image_executor.stats()["stages"]}
 
 
 # Main block
 if __name__ == "__main__":
-    api_key_file = "api_key.txt"
-    api_secret_file = "api_secret.txt"
-    api_key, api_secret = read_credentials(api_key_file, api_secret_file)
+    api_key, api_secret = config.facepp_api_key, config.facepp_api_secret
+    if not api_key or not api_secret:
+        raise SystemExit("Face++ credentials not configured")
 
     asyncio.run(video_emotion_analysis(api_key, api_secret))
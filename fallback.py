@@ -0,0 +1,45 @@
+import random
+
+# Fortunes served when neither Face++ nor GPT can be reached and nothing
+# better is cached, by dominant emotion
+CANNED_FORTUNES = {
+    "anger": [
+        "A storm that passes quickly leaves the air clearer. Breathe; tomorrow is calmer.",
+        "The fire in you today will forge something strong. Aim it well.",
+    ],
+    "disgust": [
+        "Not everything deserves your attention. Something better is on its way to you.",
+        "Your good taste will lead you away from a poor choice this week.",
+    ],
+    "fear": [
+        "The door you hesitate at opens onto friendlier rooms than you expect.",
+        "Courage is fear that said its prayers. A small brave step awaits you.",
+    ],
+    "happiness": [
+        "Your smile is contagious today. Expect it to come back to you twice over.",
+        "Good fortune follows a light heart. Keep doing what you are doing.",
+    ],
+    "neutral": [
+        "Still waters run deep. A quiet idea of yours is about to surface.",
+        "A calm mind sees clearly. An opportunity will present itself plainly.",
+    ],
+    "sadness": [
+        "Even the longest night ends with sunrise. Someone is thinking of you kindly.",
+        "Gentle days are coming. Let a friend carry part of the load.",
+    ],
+    "surprise": [
+        "The unexpected is on your side. Say yes to the next small adventure.",
+        "Life is full of plot twists, and your next one is a good one.",
+    ],
+}
+
+GENERIC_FORTUNES = [
+    "The fortune teller is resting, but the stars still smile on you today.",
+    "A pleasant surprise is waiting for you around the next corner.",
+    "Patience brings its own reward. Good news is closer than you think.",
+]
+
+
+# Function to pick a canned fortune for a dominant emotion (any emotion if unknown)
+def canned_fortune(emotion=None):
+    return random.choice(CANNED_FORTUNES.get(emotion, GENERIC_FORTUNES))
@@ -0,0 +1,99 @@
+import time
+import random
+import shelve
+import threading
+from collections import OrderedDict
+
+# Face++ emotion attributes, in a fixed order for cache keys
+EMOTIONS = ("anger", "disgust", "fear", "happiness", "neutral", "sadness", "surprise")
+
+
+# Function to turn an emotion dict (0-100 scores) into a bucket key
+def quantize_emotions(emotions, bucket_size):
+    return tuple(int(emotions.get(name, 0.0) // bucket_size) for name in EMOTIONS)
+
+
+# LRU/TTL cache of GPT fortunes keyed by quantized emotion vector.
+# Each bucket keeps up to pool_size different fortunes; until the pool is
+# full, lookups miss so that new (varied) fortunes get generated.
+class FortuneCache:
+    def __init__(self, max_entries=256, ttl=600, bucket_size=20, pool_size=3, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.bucket_size = bucket_size
+        self.pool_size = pool_size
+        self.entries = OrderedDict()  # key -> (created, [fortunes])
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = shelve.open(path) if path else None
+        if self.db is not None:
+            self._load()
+
+    def _load(self):
+        now = time.time()
+        expired = []
+        for name, (created, fortunes) in self.db.items():
+            if now - created < self.ttl:
+                self.entries[tuple(int(v) for v in name.split(","))] = (created, fortunes)
+            else:
+                expired.append(name)
+        for name in expired:
+            del self.db[name]
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def key(self, emotions):
+        return quantize_emotions(emotions, self.bucket_size)
+
+    # Return a cached fortune for these emotions, or None on a miss
+    def get(self, emotions):
+        key = self.key(emotions)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] >= self.ttl:
+                self._delete(key)
+                entry = None
+            if entry is None or len(entry[1]) < self.pool_size:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return random.choice(entry[1])
+
+    # Any unexpired fortune for these emotions, even from a bucket whose pool
+    # isn't full yet (used when GPT is unavailable); doesn't count as a hit
+    def peek(self, emotions):
+        key = self.key(emotions)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or not entry[1] or time.time() - entry[0] >= self.ttl:
+                return None
+            return random.choice(entry[1])
+
+    # Add a freshly generated fortune to the bucket's pool
+    def put(self, emotions, fortune):
+        key = self.key(emotions)
+        with self.lock:
+            created, fortunes = self.entries.pop(key, (time.time(), []))
+            if fortune not in fortunes:
+                fortunes = (fortunes + [fortune])[-self.pool_size:]
+            self.entries[key] = (created, fortunes)
+            if self.db is not None:
+                self.db[",".join(map(str, key))] = (created, fortunes)
+            while len(self.entries) > self.max_entries:
+                old_key, _ = self.entries.popitem(last=False)
+                self._delete(old_key)
+
+    def _delete(self, key):
+        self.entries.pop(key, None)
+        if self.db is not None:
+            self.db.pop(",".join(map(str, key)), None)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
@@ -1,99 +1,145 @@
-from openai import AzureOpenAI
-import os
-import requests
-import json
-
 import cv2
 import asyncio
+import logging
 from aiohttp import ClientSession, FormData
-
-# Semaphore to limit concurrent requests
-semaphore = asyncio.Semaphore(1)
-
-client = AzureOpenAI(
-    api_key=os.getenv("AZURE_KEY"),
-    azure_endpoint=os.getenv("AZURE_ENDPOINT"),
-    api_version="2023-10-01-preview"
-)
-
-
-# Function to read API credentials
-def read_credentials(api_key_file, api_secret_file):
-    with open(api_key_file, 'r') as file:
-        api_key = file.read().strip()
-    with open(api_secret_file, 'r') as file:
-        api_secret = file.read().strip()
-    return api_key, api_secret
-
-# Function to detect faces
-async def detect_faces_async(frame, api_key, api_secret, session):
-    async with semaphore:  # Use semaphore to limit concurrency
-        url = "https://api-us.faceplusplus.com/facepp/v3/detect"
-        _, img_encoded = cv2.imencode('.jpg', frame)
-
-        # Prepare the request
+from scheduler import Scheduler, INTERACTIVE
+from config import Config
+
+log = logging.getLogger("fortune")
+
+# Settings for the GPT client and the Face++ helpers below; the web app
+# passes in its own Config via configure_gpt()
+config = Config()
+
+# Process-wide Face++ rate limiter (token bucket, backs off on throttling errors)
+scheduler = Scheduler(qps=config.facepp_qps, burst=config.facepp_burst)
+
+# Global limit on in-flight GPT requests
+gpt_semaphore = asyncio.Semaphore(config.gpt_concurrency)
+
+async_client = None
+
+# Apply new settings; the GPT client is rebuilt on next use. Returns the old
+# client (or None) for the caller to close once its in-flight calls are done.
+def configure_gpt(new_config):
+    global config, async_client, gpt_semaphore
+    old_client = async_client
+    config = new_config
+    gpt_semaphore = asyncio.Semaphore(config.gpt_concurrency)
+    async_client = None
+    return old_client
+
+# Non-blocking client for use inside the event loop, created on first use
+# (importing openai is slow, so it is deferred until a fortune is needed)
+def get_async_client():
+    global async_client
+    if async_client is None:
+        from openai import AsyncAzureOpenAI
+        async_client = AsyncAzureOpenAI(
+            api_key=config.azure_key,
+            azure_endpoint=config.azure_endpoint,
+            api_version=config.azure_api_version,
+            timeout=config.gpt_timeout,
+            max_retries=0  # One attempt per call, so the timeout bounds it and the breaker sees every failure
+        )
+    return async_client
+
+# Function to get a chat completion without blocking the event loop
+async def chat_completion_async(messages, model=None):
+    async with gpt_semaphore:
+        response = await get_async_client().chat.completions.create(
+            model=model or config.gpt_model,
+            messages=messages
+        )
+    return response.choices[0].message.content
+
+# Function to stream a chat completion, yielding text pieces as they arrive
+async def chat_completion_stream(messages, model=None):
+    async with gpt_semaphore:
+        stream = await get_async_client().chat.completions.create(
+            model=model or config.gpt_model,
+            messages=messages,
+            stream=True
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+# Function to detect faces. Network errors and repeated throttling
+# propagate so retry_on_error can retry them.
+async def detect_faces_async(frame, api_key, api_secret, session, priority=INTERACTIVE):
+    url = config.facepp_url + "/detect"
+    _, img_encoded = cv2.imencode('.jpg', frame)
+    img_bytes = img_encoded.tobytes()
+
+    # Prepare the request
+    def make_form():
         form = FormData()
-        form.add_field("image_file", img_encoded.tobytes(), filename="frame.jpg", content_type="image/jpeg")
+        form.add_field("image_file", img_bytes, filename="frame.jpg", content_type="image/jpeg")
         form.add_field("api_key", api_key)
         form.add_field("api_secret", api_secret)
-
-        try:
-            async with session.post(url, data=form, ssl=False) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    print(f"[DEBUG] Detect Faces Response: {result}")
-
-                    if 'faces' in result and result['faces']:
-                        face_tokens = [face['face_token'] for face in result['faces']]
-                        print(f"[DEBUG] Retrieved Face Tokens: {face_tokens}")
-                        return face_tokens
-                else:
-                    error_text = await response.text()
-                    print(f"[DEBUG] Detect Faces Error: {response.status} - {error_text}")
-        except Exception as e:
-            print(f"[DEBUG] Detect Faces Exception: {e}")
+        return form
+
+    status, result = await scheduler.post(session, url, make_form, priority, ssl=False)
+    if status == 200:
+        log.debug("Detect Faces Response: %s", result)
+
+        if 'faces' in result and result['faces']:
+            face_tokens = [face['face_token'] for face in result['faces']]
+            log.debug("Retrieved Face Tokens: %s", face_tokens)
+            return face_tokens
+    else:
+        log.warning("Detect Faces Error: %s - %s", status, result)
     return None
 
 # Function to analyze faces
-async def analyze_faces_async(face_tokens, api_key, api_secret, session):
-    async with semaphore:  # Use semaphore to limit concurrency
-        url = "https://api-us.faceplusplus.com/facepp/v3/face/analyze"
-
-        # Prepare the request with only valid attributes
-        data = {
-            "api_key": api_key,
-            "api_secret": api_secret,
-            "face_tokens": ",".join(face_tokens),
-            "return_attributes": "emotion"  # Valid attributes
-        }
-
-        print(f"[DEBUG] Sending Face Tokens for Analysis: {face_tokens}")
-
-        try:
-            async with session.post(url, data=data, ssl=False) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    print(f"[DEBUG] Analyze Faces Response: {result}")
-                    return result
-                else:
-                    error_text = await response.text()
-                    print(f"[DEBUG] Analyze Faces Error: {response.status} - {error_text}")
-        except Exception as e:
-            print(f"[DEBUG] Analyze Faces Exception: {e}")
+async def analyze_faces_async(face_tokens, api_key, api_secret, session, priority=INTERACTIVE):
+    url = config.facepp_url + "/face/analyze"
+
+    # Prepare the request payload
+    request_payload = {
+        "api_key": api_key,
+        "api_secret": api_secret,
+        "face_tokens": ",".join(face_tokens),
+        "return_attributes": "emotion"  # Valid attributes
+    }
+
+    log.debug("Sending Face Tokens for Analysis: %s", face_tokens)
+
+    status, result = await scheduler.post(session, url, lambda: request_payload, priority, ssl=False)
+    if status == 200:
+        log.debug("Analyze Faces Response: %s", result)
+        return result
+    log.warning("Analyze Faces Error: %s - %s", status, result)
     return None
 
-
 # Retry mechanism with exponential backoff
 async def retry_on_error(coro_func, retries=3, delay=2):
     for attempt in range(retries):
         try:
             return await coro_func()  # Properly call the coroutine
         except Exception as e:
-            print(f"[DEBUG] Retry ({attempt + 1}/{retries}) after error: {e}")
+            log.warning("Retry (%s/%s) after error: %s", attempt + 1, retries, e)
             await asyncio.sleep(delay * (2 ** attempt))  # Exponential backoff
-    print("[DEBUG] All retries failed.")
+    log.warning("All retries failed.")
     return None
 
+# Face++ face/analyze accepts at most 5 face_tokens per call
+ANALYZE_BATCH_SIZE = 5
+
+# Split face tokens into chunks of at most 5, analyze the chunks concurrently
+# (analyze(chunk) returns a coroutine) and merge the faces into one result
+async def analyze_in_batches(analyze, face_tokens, batch_size=ANALYZE_BATCH_SIZE):
+    chunks = [face_tokens[i:i + batch_size] for i in range(0, len(face_tokens), batch_size)]
+    results = await asyncio.gather(*(analyze(chunk) for chunk in chunks))
+    results = [result for result in results if result and 'faces' in result]
+    if not results:
+        return None
+    merged = dict(results[0])
+    merged['faces'] = [face for result in results for face in result['faces']]
+    return merged
+
 # Video processing function
 async def video_emotion_analysis(api_key, api_secret):
     cap = cv2.VideoCapture(0)
@@ -104,7 +150,7 @@ async def video_emotion_analysis(api_key, api_secret):
         while True:
             ret, frame = cap.read()
             if not ret:
-                print("Failed to capture frame. Exiting...")
+                log.error("Failed to capture frame. Exiting...")
                 break
 
             # Resize frame for faster processing
@@ -115,7 +161,7 @@ async def video_emotion_analysis(api_key, api_secret):
             emotion_text = "Analyzing..."
 
             if frame_count % frame_interval == 0:
-                print("[DEBUG] Processing frame...")
+                log.debug("Processing frame...")
                 
                 # Step 1: Detect faces with retry
                 face_tokens = await retry_on_error(
@@ -123,11 +169,12 @@ async def video_emotion_analysis(api_key, api_secret):
                 )
 
                 if face_tokens:
-                    await asyncio.sleep(1.0)  # Add a delay between requests
-
                     # Step 2: Analyze faces with retry
-                    analyze_result = await retry_on_error(
-                        lambda: analyze_faces_async(face_tokens, api_key, api_secret, session)
+                    analyze_result = await analyze_in_batches(
+                        lambda chunk: retry_on_error(
+                            lambda: analyze_faces_async(chunk, api_key, api_secret, session)
+                        ),
+                        face_tokens
                     )
 
                     if analyze_result and 'faces' in analyze_result:
@@ -139,7 +186,7 @@ async def video_emotion_analysis(api_key, api_secret):
                             emotions = attributes.get('emotion', {})
                             dominant_emotion = max(emotions, key=emotions.get) if emotions else "N/A"
 
-                            print(f"[DEBUG] Face Analysis - Emotion: {dominant_emotion}")
+                            log.debug("Face Analysis - Emotion: %s", dominant_emotion)
 
                             # Annotate the frame
                             cv2.rectangle(frame,
@@ -169,18 +216,14 @@ async def video_emotion_analysis(api_key, api_secret):
 
 
                             try:
-                                response = openai.ChatCompletion.create(
-                                    engine="gpt-4",  # Specify the engine if needed
-                                    messages=messages
-                                )
-                                chat_response = response['choices'][0]['message']['content']
-                                print("[DEBUG] GPT Response Content:", chat_response)
+                                chat_response = await chat_completion_async(messages)
+                                log.debug("GPT Response Content: %s", chat_response)
                                 return chat_response
 
                                 # Append GPT response to maintain conversation history
                                 messages.append({"role": "assistant", "content": chat_response})
                             except Exception as e:
-                                print(f"[DEBUG] GPT API Exception: {e}")
+                                log.warning("GPT API Exception: %s", e)
 
             # Show the video feed
             cv2.imshow("Emotion Analysis", frame)
@@ -195,10 +238,13 @@ async def video_emotion_analysis(api_key, api_secret):
 
 # Main function
 if __name__ == "__main__":
-    # Read API credentials
-    api_key_file = "api_key.txt"
-    api_secret_file = "api_secret.txt"
-    api_key, api_secret = read_credentials(api_key_file, api_secret_file)
+    # Debug logging (DEBUG_LOG=1)
+    logging.basicConfig(format="[%(levelname)s] %(message)s",
+                        level=logging.DEBUG if config.debug_log else logging.INFO)
+
+    api_key, api_secret = config.facepp_api_key, config.facepp_api_secret
+    if not api_key or not api_secret:
+        raise SystemExit("Face++ credentials not configured")
 
     # Run the video emotion analysis
     asyncio.run(video_emotion_analysis(api_key, api_secret))
\ No newline at end of file
@@ -0,0 +1,94 @@
+import threading
+import cv2
+import numpy as np
+
+# JPEG start-of-frame markers (baseline, extended, progressive, lossless...)
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+# Function to read (width, height) from JPEG headers without decoding; None if not a JPEG
+def jpeg_size(data):
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    pos = 2
+    while pos + 9 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # Fill byte
+            pos += 1
+            continue
+        if marker == 0xD8 or 0xD0 <= marker <= 0xD7 or marker == 0x01:  # No length field
+            pos += 2
+            continue
+        length = (data[pos + 2] << 8) | data[pos + 3]
+        if marker in SOF_MARKERS:
+            height = (data[pos + 5] << 8) | data[pos + 6]
+            width = (data[pos + 7] << 8) | data[pos + 8]
+            return width, height
+        pos += 2 + length
+    return None
+
+
+# Function to decode JPEG bytes; grayscale/reduce (1, 2, 4 or 8) use libjpeg's cheaper paths
+def decode_frame(data, grayscale=False, reduce=1):
+    flags = {
+        (False, 1): cv2.IMREAD_COLOR, (True, 1): cv2.IMREAD_GRAYSCALE,
+        (False, 2): cv2.IMREAD_REDUCED_COLOR_2, (True, 2): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+        (False, 4): cv2.IMREAD_REDUCED_COLOR_4, (True, 4): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+        (False, 8): cv2.IMREAD_REDUCED_COLOR_8, (True, 8): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    }[(grayscale, reduce)]
+    return cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+
+
+# Function to encode a frame as JPEG bytes
+def encode_frame(frame, quality=80):
+    ok, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    return encoded.tobytes() if ok else None
+
+
+# Function to shrink a frame to fit within max_width x max_height
+def fit_frame(frame, max_width, max_height):
+    height, width = frame.shape[:2]
+    scale = min(1.0, max_width / width, max_height / height)
+    if scale >= 1.0:
+        return frame
+    return cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+
+
+# Largest libjpeg reduction factor that keeps the width at or above min_width
+def reduce_factor(width, min_width):
+    for factor in (8, 4, 2):
+        if width // factor >= min_width:
+            return factor
+    return 1
+
+
+# Per-frame upload counters: bytes received, bytes sent to Face++, CPU time
+class CodecStats:
+    def __init__(self):
+        self.frames = 0
+        self.passthrough = 0  # Frames forwarded without decode/re-encode
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, bytes_in, bytes_out, cpu_seconds, passthrough):
+        with self.lock:
+            self.frames += 1
+            self.passthrough += int(passthrough)
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.cpu_seconds += cpu_seconds
+
+    def stats(self):
+        with self.lock:
+            frames = max(1, self.frames)
+            return {
+                "frames": self.frames,
+                "passthrough": self.passthrough,
+                "bytes_in_per_frame": self.bytes_in / frames,
+                "bytes_out_per_frame": self.bytes_out / frames,
+                "cpu_ms_per_frame": self.cpu_seconds * 1000 / frames,
+            }
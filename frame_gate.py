@@ -0,0 +1,80 @@
+import time
+import threading
+from collections import OrderedDict
+import cv2
+import numpy as np
+
+
+# Function to shrink a frame to a small grayscale thumbnail for comparison
+def frame_signature(frame, size=(32, 24)):
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+# Scene-change gate: a frame is worth analyzing only if it differs enough
+# from the last analyzed one, or the last result is older than max_staleness.
+class FrameGate:
+    def __init__(self, threshold=6.0, max_staleness=30.0, size=(32, 24)):
+        self.threshold = threshold          # Mean absolute gray-level difference (0-255)
+        self.max_staleness = max_staleness  # Seconds a result may be reused
+        self.size = size
+        self.reference = None  # Signature of the last analyzed frame
+        self.result = None     # Result for the reference frame
+        self.updated = 0.0
+        self.pending = None
+        self.analyzed = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    # Returns (True, None) if the frame should be analyzed, else (False, last_result)
+    def check(self, frame, now=None):
+        now = time.monotonic() if now is None else now
+        signature = frame_signature(frame, self.size)
+        with self.lock:
+            if (self.reference is not None and self.result is not None
+                    and now - self.updated < self.max_staleness
+                    and np.abs(signature - self.reference).mean() < self.threshold):
+                self.skipped += 1
+                return False, self.result
+            self.pending = signature
+            self.analyzed += 1
+            return True, None
+
+    # Remember the result of the frame passed to the last positive check()
+    def store(self, result, now=None):
+        with self.lock:
+            if self.pending is None:
+                return
+            self.reference, self.pending = self.pending, None
+            self.result = result
+            self.updated = time.monotonic() if now is None else now
+
+    def stats(self):
+        with self.lock:
+            return {"analyzed": self.analyzed, "skipped": self.skipped}
+
+
+# One FrameGate per client session, least recently used sessions dropped first
+class FrameGates:
+    def __init__(self, max_sessions=256, **gate_options):
+        self.max_sessions = max_sessions
+        self.gate_options = gate_options
+        self.gates = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, client_id):
+        with self.lock:
+            gate = self.gates.pop(client_id, None) or FrameGate(**self.gate_options)
+            self.gates[client_id] = gate
+            while len(self.gates) > self.max_sessions:
+                self.gates.popitem(last=False)
+            return gate
+
+    def stats(self):
+        with self.lock:
+            gates = list(self.gates.values())
+        totals = {"sessions": len(gates), "analyzed": 0, "skipped": 0}
+        for gate in gates:
+            for name, value in gate.stats().items():
+                totals[name] += value
+        return totals
@@ -0,0 +1,218 @@
+import os
+import time
+import asyncio
+import threading
+import multiprocessing
+import concurrent.futures
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from frame_codec import encode_frame, fit_frame
+from metrics import stage_cpu_seconds
+
+# Payloads at least this big cross the process boundary through shared
+# memory; smaller ones (compressed JPEGs, thumbnails) are cheaper to pickle
+SHARED_MIN_BYTES = 64 * 1024
+
+
+# A NumPy array in a named shared memory block. Pickling it sends only the
+# name, shape and dtype; the receiving process maps the same pages.
+class SharedArray:
+    def __init__(self, name, shape, dtype, create=False):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+        size = max(1, int(np.prod(self.shape)) * np.dtype(dtype).itemsize)
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size if create else 0)
+        self.array = np.ndarray(self.shape, self.dtype, buffer=self.shm.buf)
+
+    # New block holding a copy of an array or of raw bytes (as a uint8 array)
+    @classmethod
+    def copy_of(cls, data):
+        source = data if isinstance(data, np.ndarray) else np.frombuffer(data, np.uint8)
+        shared = cls(None, source.shape, source.dtype, create=True)
+        shared.array[...] = source
+        return shared
+
+    def __reduce__(self):
+        return SharedArray, (self.shm.name, self.shape, self.dtype)
+
+    # Unmap this process's view; the block itself lives on until released
+    def close(self):
+        self.array = None
+        self.shm.close()
+
+    # Unmap and free the block
+    def release(self):
+        self.close()
+        self.shm.unlink()
+
+
+def is_large(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes >= SHARED_MIN_BYTES
+    return isinstance(value, (bytes, bytearray)) and len(value) >= SHARED_MIN_BYTES
+
+
+# Run one task and measure its CPU time. In a worker process, shared
+# arguments arrive as SharedArray handles and large array results are
+# handed back in a new shared block for the caller to release.
+def run_task(func, args, shared_result=False):
+    shared_args = [arg for arg in args if isinstance(arg, SharedArray)]
+    start = time.thread_time()
+    try:
+        result = func(*[arg.array if isinstance(arg, SharedArray) else arg for arg in args])
+        if shared_result and is_large(result):
+            result = SharedArray.copy_of(result)
+            result.close()
+        return result, time.thread_time() - start
+    finally:
+        for arg in shared_args:
+            try:
+                arg.close()
+            except BufferError:
+                pass  # A small result still views the block; it is unmapped once that is pickled
+
+
+# Face filter used by the detect tasks: the app's own filter in inline and
+# thread mode, a forked copy in each worker process
+worker_filter = None
+
+def init_worker(face_filter):
+    global worker_filter
+    worker_filter = face_filter
+
+
+# Image tasks. Frames may be views of shared memory, so results never alias them.
+def detect_faces(frame, reduce=1):
+    return worker_filter.detect(frame, reduce)
+
+def crop_and_encode(frame, boxes, quality):
+    region, transform = worker_filter.crop(frame, boxes)
+    return encode_frame(region, quality), transform
+
+def fit_and_encode(frame, max_width, max_height, quality):
+    height = frame.shape[0]
+    fitted = fit_frame(frame, max_width, max_height)
+    return encode_frame(fitted, quality), (0, 0, fitted.shape[0] / height)
+
+
+# Executor stage for CPU-heavy image transforms (decode, filter, resize,
+# encode), so they run on a bounded pool instead of the request threads or
+# the event loop:
+#   inline  - run in the calling thread (the old behaviour)
+#   thread  - a thread pool; OpenCV releases the GIL while it works
+#   process - forked worker processes; frames travel through shared memory
+class ImageExecutor:
+    def __init__(self, mode="thread", workers=None, face_filter=None):
+        self.mode = mode
+        self.workers = workers or os.cpu_count() or 1
+        self.stages = {}  # stage -> [calls, cpu seconds, wall seconds]
+        self.shared_bytes = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        if mode == "process":
+            # Fork so workers don't re-import the app; start them all now,
+            # before the app starts its own threads. The shared memory resource
+            # tracker is started first so workers inherit it: blocks created in
+            # one process and unlinked in another are then tracked by one
+            # tracker, instead of piling up in per-worker trackers that report
+            # them as leaked at exit.
+            resource_tracker.ensure_running()
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("fork" if "fork" in methods else None)
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=context, initializer=init_worker, initargs=(face_filter,)
+            )
+            self.pool.submit(time.sleep, 0).result()
+        else:
+            init_worker(face_filter)
+            self.pool = concurrent.futures.ThreadPoolExecutor(
+                self.workers, thread_name_prefix="image"
+            ) if mode == "thread" else None
+
+    # Returns (future of (result, cpu seconds), shared inputs to release)
+    def submit(self, func, args):
+        if self.pool is None:
+            future = concurrent.futures.Future()
+            future.set_result(run_task(func, args))
+            return future, []
+        if self.mode != "process":
+            return self.pool.submit(run_task, func, args), []
+        shared = []
+        args = list(args)
+        for i, arg in enumerate(args):
+            if is_large(arg):
+                args[i] = SharedArray.copy_of(arg)
+                shared.append(args[i])
+        with self.lock:
+            self.shared_bytes += sum(arg.array.nbytes for arg in shared)
+        return self.pool.submit(run_task, func, args, True), shared
+
+    def finish(self, stage, start, outcome):
+        result, cpu_seconds = outcome
+        if isinstance(result, SharedArray):
+            shared, result = result, result.array.copy()
+            shared.release()
+        if self.pool is not None:
+            self.local.cpu_seconds = getattr(self.local, "cpu_seconds", 0.0) + cpu_seconds
+        stage_cpu_seconds.observe(stage, cpu_seconds)
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += cpu_seconds
+            totals[2] += time.perf_counter() - start
+        return result
+
+    # Run func(*args) as one stage and wait for its result (from a request thread)
+    def run(self, stage, func, *args):
+        start = time.perf_counter()
+        future, shared = self.submit(func, args)
+        try:
+            outcome = future.result()
+        finally:
+            for arg in shared:
+                arg.release()
+        return self.finish(stage, start, outcome)
+
+    # Same, from a coroutine: the event loop keeps running while the pool works
+    async def run_async(self, stage, func, *args):
+        start = time.perf_counter()
+        future, shared = self.submit(func, args)
+        try:
+            outcome = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(discard_result)
+            raise
+        finally:
+            for arg in shared:
+                arg.release()
+        return self.finish(stage, start, outcome)
+
+    # CPU seconds used by the calling thread, plus pool work done on its behalf
+    def thread_time(self):
+        return time.thread_time() + getattr(self.local, "cpu_seconds", 0.0)
+
+    def stats(self):
+        with self.lock:
+            stages = {
+                stage: {
+                    "calls": calls,
+                    "cpu_seconds": cpu_seconds,
+                    "cpu_ms_per_call": cpu_seconds * 1000 / calls,
+                    "wall_ms_per_call": wall_seconds * 1000 / calls,
+                }
+                for stage, (calls, cpu_seconds, wall_seconds) in self.stages.items()
+            }
+            return {"mode": self.mode, "workers": self.workers,
+                    "shared_bytes": self.shared_bytes, "stages": stages}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Free the shared result of a task nobody is waiting for anymore
+def discard_result(future):
+    if not future.cancelled() and future.exception() is None:
+        result, _ = future.result()
+        if isinstance(result, SharedArray):
+            result.release()
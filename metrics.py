@@ -0,0 +1,89 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Default latency buckets (seconds), from local CPU work up to slow GPT calls
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# Cumulative histogram of observations, one series per label value
+class Histogram:
+    def __init__(self, name, help_text, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self.series = {}  # label value -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = sorted((key, list(series)) for key, series in self.series.items())
+        for label_value, series in items:
+            label = f'{self.label}="{label_value}"'
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{label}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{label}}} {series[-1]}")
+        return lines
+
+
+# Monotonic counters, one series per label value
+class Counter:
+    def __init__(self, name, help_text, label):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_value, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for label_value, value in items:
+            lines.append(f'{self.name}{{{self.label}="{label_value}"}} {value}')
+        return lines
+
+
+# Per-stage timings: decode, encode, detect, analyze, gpt, ...
+stage_seconds = Histogram("fortune_stage_seconds", "Time spent in each pipeline stage", "stage")
+
+# CPU time per image stage (decode, filter, encode, resize), measured in the
+# pool thread or worker process that did the work; use it to size IMAGE_WORKERS
+stage_cpu_seconds = Histogram("fortune_stage_cpu_seconds", "CPU time spent in each image stage", "stage")
+
+# Frame outcomes: analyzed, reused (frame gate), filtered (local face filter), cache hits/misses, ...
+events_total = Counter("fortune_events_total", "Pipeline events by kind", "event")
+
+
+# Time a block (sync or around awaits) as one observation of the given stage
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(stage, time.perf_counter() - start)
+
+
+# Prometheus text exposition of all metrics
+def render():
+    return "\n".join(stage_seconds.render() + stage_cpu_seconds.render() + events_total.render()) + "\n"
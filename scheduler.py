@@ -0,0 +1,119 @@
+import heapq
+import random
+import asyncio
+import itertools
+
+# Request priorities: lower numbers are served first
+INTERACTIVE = 0  # A person is waiting on the result (web requests, live preview)
+BACKGROUND = 1   # Batch jobs, cache/pool refills
+
+
+class RateLimited(Exception):
+    pass
+
+
+# Function to tell whether a Face++ response means "slow down"
+def is_throttled(status, text):
+    return status == 429 or (status == 403 and "CONCURRENCY_LIMIT_EXCEEDED" in text)
+
+
+# Process-wide Face++ request scheduler: a token bucket enforces the
+# configured QPS (0 or less means unlimited), waiters are served by priority,
+# and throttling errors pause everyone with jittered exponential backoff.
+class Scheduler:
+    def __init__(self, qps=10.0, burst=None, base_backoff=0.5, max_backoff=8.0):
+        self.qps = qps
+        self.burst = burst or max(1.0, qps)
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.tokens = self.burst
+        self.updated = None
+        self.paused_until = 0.0
+        self.failures = 0  # Consecutive throttling errors
+        self.waiters = []  # Heap of (priority, seq, future)
+        self.seq = itertools.count()
+        self.dispatcher = None
+        self.granted = 0
+        self.throttles = 0
+
+    # Wait until a request may be sent
+    async def acquire(self, priority=INTERACTIVE):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self.waiters, (priority, next(self.seq), future))
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = loop.create_task(self._dispatch())
+        await future
+
+    # If dispatching fails, the waiters get the error instead of waiting forever
+    async def _dispatch(self):
+        try:
+            await self._grant()
+        except BaseException as e:
+            while self.waiters:
+                _, _, future = heapq.heappop(self.waiters)
+                if future.done():
+                    continue
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+
+    async def _grant(self):
+        loop = asyncio.get_running_loop()
+        while self.waiters:
+            now = loop.time()
+            limited = self.qps > 0
+            if limited and self.updated is not None:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.qps)
+            self.updated = now
+
+            wait = self.paused_until - now
+            if limited and self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.qps)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            _, _, future = heapq.heappop(self.waiters)
+            if future.done():  # Waiter was cancelled
+                continue
+            if limited:
+                self.tokens -= 1
+            self.granted += 1
+            future.set_result(None)
+
+    # Back off after a throttling response; all waiters are held until the pause ends
+    def throttled(self):
+        self.failures += 1
+        self.throttles += 1
+        delay = min(self.max_backoff, self.base_backoff * 2 ** (self.failures - 1))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        self.paused_until = max(self.paused_until, asyncio.get_running_loop().time() + delay)
+        self.tokens = 0
+
+    def succeeded(self):
+        self.failures = 0
+
+    # POST through the scheduler, retrying throttled calls. make_data() builds
+    # a fresh request body per attempt (aiohttp FormData can only be sent once).
+    # Returns (status, body): parsed JSON for 200, response text otherwise.
+    async def post(self, session, url, make_data, priority=INTERACTIVE, retries=3, **kwargs):
+        for attempt in range(retries + 1):
+            await self.acquire(priority)
+            async with session.post(url, data=make_data(), **kwargs) as response:
+                if response.status == 200:
+                    self.succeeded()
+                    return response.status, await response.json()
+                text = await response.text()
+                if not is_throttled(response.status, text):
+                    self.succeeded()
+                    return response.status, text
+            self.throttled()
+        raise RateLimited(f"Throttled {retries + 1} times: {url}")
+
+    def stats(self):
+        return {"qps": self.qps, "granted": self.granted, "throttled": self.throttles,
+                "waiting": len(self.waiters)}
@@ -0,0 +1,114 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+# Function to compute the intersection over union of two (x, y, w, h) boxes
+def iou(a, b):
+    left, top = max(a[0], b[0]), max(a[1], b[1])
+    right, bottom = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    inter = max(0, right - left) * max(0, bottom - top)
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+
+# Function to tell whether a Face++ face_rectangle's center lies inside a local box
+def contains_center(box, rect):
+    x, y = rect["left"] + rect["width"] / 2, rect["top"] + rect["height"] / 2
+    return box[0] <= x < box[0] + box[2] and box[1] <= y < box[1] + box[3]
+
+
+# Per-client face tracks: the local detector's boxes from the last analyzed
+# frame, paired with the Face++ results for those faces. While the local
+# detector keeps seeing the same faces (one per track, each overlapping its
+# previous box by at least min_iou), the Face++ results are reused and
+# detect/analyze are skipped, until the tracks are ttl seconds old.
+class TrackCache:
+    def __init__(self, max_clients=256, ttl=10.0, min_iou=0.5):
+        self.max_clients = max_clients
+        self.ttl = ttl
+        self.min_iou = min_iou
+        self.tracks = OrderedDict()  # client_id -> (analyzed, [box], [Face++ face])
+        self.viewers = OrderedDict()  # client_id -> ([(viewer id, box)], next viewer id)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Face++ faces for the current local boxes, or None if any face is new,
+    # gone or has moved too far
+    def lookup(self, client_id, boxes, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            entry = self.tracks.get(client_id)
+            if entry is None or now - entry[0] >= self.ttl or len(entry[1]) != len(boxes):
+                self.misses += 1
+                return None
+            analyzed, track_boxes, faces = entry
+            unmatched = list(range(len(track_boxes)))
+            moved = list(track_boxes)
+            for box in boxes:
+                best = max(unmatched, key=lambda i: iou(box, track_boxes[i]))
+                if iou(box, track_boxes[best]) < self.min_iou:
+                    self.misses += 1
+                    return None
+                unmatched.remove(best)
+                moved[best] = box
+            # Follow slow drift; the age stays that of the last real analysis
+            self.tracks[client_id] = (analyzed, moved, faces)
+            self.tracks.move_to_end(client_id)
+            self.hits += 1
+            return faces
+
+    # Pair fresh Face++ faces with the local boxes and remember them. Nothing
+    # is stored unless every face pairs with exactly one box.
+    def store(self, client_id, boxes, faces, now=None):
+        now = time.monotonic() if now is None else now
+        paired = []
+        for face in faces:
+            rect = face.get("face_rectangle")
+            matches = [box for box in boxes if rect is not None and contains_center(box, rect)]
+            if len(matches) != 1 or matches[0] in paired:
+                with self.lock:
+                    self.tracks.pop(client_id, None)
+                return False
+            paired.append(matches[0])
+        if len(paired) != len(boxes):
+            with self.lock:
+                self.tracks.pop(client_id, None)
+            return False
+        with self.lock:
+            self.tracks.pop(client_id, None)
+            self.tracks[client_id] = (now, paired, faces)
+            while len(self.tracks) > self.max_clients:
+                self.tracks.popitem(last=False)
+        return True
+
+    # Stable viewer ids for Face++ faces. Face++ orders faces by size, so a
+    # face's index changes whenever two people change relative size; instead
+    # each face keeps the id of the face it overlaps most in the client's
+    # previous frame, and faces overlapping none get new ids.
+    def identify(self, client_id, faces):
+        boxes = []
+        for face in faces:
+            rect = face.get("face_rectangle")
+            boxes.append((rect["left"], rect["top"], rect["width"], rect["height"]) if rect else None)
+        with self.lock:
+            previous, next_id = self.viewers.pop(client_id, ([], 0))
+            pairs = sorted(((iou(box, old), i, j) for i, box in enumerate(boxes) if box is not None
+                            for j, (_, old) in enumerate(previous)), reverse=True)
+            ids, taken = [None] * len(boxes), set()
+            for overlap, i, j in pairs:
+                if overlap > 0 and ids[i] is None and j not in taken:
+                    ids[i] = previous[j][0]
+                    taken.add(j)
+            for i in range(len(ids)):
+                if ids[i] is None:
+                    ids[i], next_id = next_id, next_id + 1
+            self.viewers[client_id] = ([(id_, box) for id_, box in zip(ids, boxes) if box is not None], next_id)
+            while len(self.viewers) > self.max_clients:
+                self.viewers.popitem(last=False)
+        return ids
+
+    def stats(self):
+        with self.lock:
+            return {"clients": len(self.tracks), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from fortune_cache import EMOTIONS
+
+log = logging.getLogger("fortune")
+
+# Intensity bands of the dominant emotion's score (0-100): (name, lower bound)
+INTENSITY_BANDS = (("mild", 0.0), ("moderate", 40.0), ("strong", 70.0))
+
+
+# Function to map an emotion dict to its pool slot: (dominant emotion, intensity band)
+def pool_key(emotions):
+    emotion = max(emotions, key=emotions.get)
+    band = [name for name, lower in INTENSITY_BANDS if emotions[emotion] >= lower][-1]
+    return emotion, band
+
+
+# Pre-generated fortunes for every dominant emotion and intensity band, so a
+# viewer can get a fortune without waiting on GPT. Served fortunes are removed;
+# a background task (run()) tops the pool back up, at most `budget` GPT calls
+# per hour. The pool is kept in a small JSON file and reloaded at startup.
+class WarmPool:
+    def __init__(self, generate, size=5, budget=60, path=None, retry_delay=30.0):
+        self.generate = generate  # async (emotion, band) -> fortune text
+        self.size = size          # Fortunes kept per slot
+        self.budget = budget      # Refill calls per hour
+        self.path = path
+        self.retry_delay = retry_delay
+        self.fortunes = {(emotion, band): deque() for emotion in EMOTIONS for band, _ in INTENSITY_BANDS}
+        self.calls = deque()  # Times of refill calls in the last hour
+        self.wakeup = None    # Set when a fortune is taken; created on the event loop
+        self.served = 0
+        self.empty = 0
+        self.generated = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as file:
+                stored = json.load(file)
+        except (OSError, ValueError) as e:
+            log.warning("Warm pool not loaded from %s: %s", self.path, e)
+            return
+        for name, fortunes in stored.items():
+            key = tuple(name.split(":", 1))
+            if key in self.fortunes:
+                self.fortunes[key].extend(fortunes[:self.size])
+
+    # Write the pool atomically, so a crash never leaves a half-written file
+    def _save(self):
+        if not self.path:
+            return
+        with self.lock:
+            stored = {f"{emotion}:{band}": list(fortunes) for (emotion, band), fortunes in self.fortunes.items()}
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as file:
+                json.dump(stored, file, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.warning("Warm pool not saved to %s: %s", self.path, e)
+
+    # Take a fortune for these emotions, or None if that slot is empty.
+    # Must be called on the event loop that runs run().
+    def take(self, emotions):
+        key = pool_key(emotions)
+        with self.lock:
+            fortunes = self.fortunes[key]
+            if fortunes:
+                self.served += 1
+                fortune = fortunes.popleft()
+            else:
+                self.empty += 1
+                fortune = None
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return fortune
+
+    # The slot with the fewest fortunes, or None if every slot is full
+    def _next_key(self):
+        with self.lock:
+            key, fortunes = min(self.fortunes.items(), key=lambda item: len(item[1]))
+            return key if len(fortunes) < self.size else None
+
+    # Seconds until the hourly refill budget allows another call
+    def _budget_wait(self, now):
+        while self.calls and now - self.calls[0] >= 3600:
+            self.calls.popleft()
+        if len(self.calls) < self.budget:
+            return 0.0
+        return self.calls[0] + 3600 - now
+
+    # Background refill task: runs on the app's event loop until cancelled.
+    # A budget of 0 (or less) means no refills; stored fortunes are still served.
+    async def run(self):
+        if self.budget <= 0:
+            log.info("Warm pool refill disabled (budget %s)", self.budget)
+            return
+        self.wakeup = asyncio.Event()
+        while True:
+            key = self._next_key()
+            if key is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            wait = self._budget_wait(time.monotonic())
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            self.calls.append(time.monotonic())
+            try:
+                fortune = await self.generate(*key)
+            except Exception as e:
+                self.failed += 1
+                log.warning("Warm pool refill failed for %s/%s: %s", key[0], key[1], e)
+                await asyncio.sleep(self.retry_delay)
+                continue
+            with self.lock:
+                self.fortunes[key].append(fortune)
+                self.generated += 1
+            await asyncio.to_thread(self._save)  # Keep file I/O off the shared loop
+
+    def stats(self):
+        with self.lock:
+            return {
+                "fortunes": sum(len(fortunes) for fortunes in self.fortunes.values()),
+                "capacity": self.size * len(self.fortunes),
+                "served": self.served,
+                "empty": self.empty,
+                "generated": self.generated,
+                "failed": self.failed,
+            }
+
+    def close(self):
+        self._save()